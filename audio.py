@@ -1,39 +1,167 @@
+import functools
+import wave
+
 import numpy as np
+import torch
 import torchaudio
 from torch import Tensor
 
+from cache import file_hash
+
+
+# ядро ресемплера считается один раз для каждой пары частот и переиспользуется между вызовами
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_freq: int, new_freq: int) -> torchaudio.transforms.Resample:
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
+def resample(waveform: Tensor, orig_freq: int, new_freq: int) -> Tensor:
+    if orig_freq == new_freq:
+        return waveform
 
+    return get_resampler(orig_freq, new_freq)(waveform)
+
+
+# Файл декодируется один раз и сразу приводится к моно 16 кГц float32:
+# в таком виде аудио принимают и Whisper, и pyannote, и модель эмбеддингов
 class Audio:
     def __init__(self, path: str):
         self.path = path
-        self.target_sr = 44100
-        self.waveform, self.sr = torchaudio.load(path)
+        self.hash: str | None = None
+        self.target_sr = 16000
+
+        waveform, sr = torchaudio.load(path)
+        self.orig_sr = sr
+        self.num_frames = waveform.shape[1]
+
+        mono_wf = waveform.mean(dim=0, keepdim=True)
+        del waveform
+
+        self.waveform = resample(mono_wf, sr, self.target_sr).contiguous()
+        self.sr = self.target_sr
 
     def requires_resample(self) -> bool:
-        return self.sr == self.target_sr
+        return self.orig_sr != self.target_sr
 
-    def numpy(self):
-        mono_wf = self.waveform.mean(dim=0)
-        sr = 16000
-        inp = self.resample(mono_wf, sr).numpy().astype(np.float32)
+    def content_hash(self) -> str:
+        if self.hash is None:
+            self.hash = file_hash(self.path)
+
+        return self.hash
 
-        return inp
+    def numpy(self):
+        return self.waveform[0].numpy()
 
     def resample(self, input, target):
-        resampler = torchaudio.transforms.Resample(orig_freq=self.sr, new_freq=target)
-        return resampler(input)
+        return resample(input, self.sr, target)
+
+    def crop(self, start: float, end: float) -> Tensor:
+        return self.waveform[:, int(start * self.sr):int(end * self.sr)]
+
+    def chunks(self, window: float = 600.0):
+        duration = self.waveform.shape[1] / self.sr
+        offset = 0.0
+
+        while offset < duration:
+            yield offset, self.crop(offset, offset + window)
+            offset += window
 
     def __call__(self):
-        if self.requires_resample():
-            self.waveform = self.resample(self.waveform, self.target_sr)
+        return {"waveform": self.waveform, "sample_rate": self.sr, "uri": "audio"}
+
+    def get_audio_duration(self):
+        return self.num_frames / self.orig_sr
+
+
+def pcm_to_float(raw: bytes, sample_width: int, channels: int) -> np.ndarray:
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 2**15
+    elif sample_width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        ints = np.where(ints >= 2**23, ints - 2**24, ints)
+        samples = ints.astype(np.float32) / 2**23
+    elif sample_width == 4:
+        samples = np.frombuffer(raw, dtype="<i4").astype(np.float32) / 2**31
+    else:
+        raise RuntimeError(f"Unsupported sample width: {sample_width}")
 
-        return {"waveform": self.waveform, "sample_rate": self.target_sr, "uri": "audio"}
+    return samples.reshape(-1, channels).mean(axis=1)
+
+
+# Читает WAV окнами фиксированной длины, каждое окно отдельно сводится в моно и ресемплится.
+# Исходная волна целиком в памяти никогда не лежит, поэтому потребление памяти
+# не зависит от длины записи
+class StreamingAudio:
+    def __init__(self, path: str, window: float = 600.0):
+        self.path = path
+        self.hash: str | None = None
+        self.target_sr = 16000
+        self.sr = self.target_sr
+        self.window = window
+
+        with wave.open(path, "rb") as f:
+            self.orig_sr = f.getframerate()
+            self.channels = f.getnchannels()
+            self.sample_width = f.getsampwidth()
+            self.num_frames = f.getnframes()
+
+    @staticmethod
+    def supports(path: str) -> bool:
+        try:
+            with wave.open(path, "rb"):
+                return True
+        except (wave.Error, EOFError):
+            return False
+
+    def requires_resample(self) -> bool:
+        return self.orig_sr != self.target_sr
+
+    def content_hash(self) -> str:
+        if self.hash is None:
+            self.hash = file_hash(self.path)
+
+        return self.hash
+
+    def crop(self, start: float, end: float) -> Tensor:
+        first = max(int(start * self.orig_sr), 0)
+        last = min(int(end * self.orig_sr), self.num_frames)
+
+        if last <= first:
+            return torch.zeros(1, 0)
+
+        with wave.open(self.path, "rb") as f:
+            f.setpos(first)
+            raw = f.readframes(last - first)
+
+        samples = torch.from_numpy(pcm_to_float(raw, self.sample_width, self.channels)).unsqueeze(0)
+        return resample(samples, self.orig_sr, self.sr)
+
+    def chunks(self, window: float | None = None):
+        window = window or self.window
+        duration = self.get_audio_duration()
+        offset = 0.0
+
+        while offset < duration:
+            yield offset, self.crop(offset, offset + window)
+            offset += window
+
+    # pyannote нужна вся запись, но собираем ее уже в моно 16 кГц, а не в исходном формате
+    def __call__(self):
+        waveform = torch.cat([chunk for _, chunk in self.chunks()], dim=1)
+        return {"waveform": waveform, "sample_rate": self.sr, "uri": "audio"}
 
     def get_audio_duration(self):
-        info = torchaudio.info(self.path)
+        return self.num_frames / self.orig_sr
+
+
+def open_audio(path: str, streaming: bool = False):
+    if streaming and StreamingAudio.supports(path):
+        return StreamingAudio(path)
 
-        duration = info.num_frames / info.sample_rate
-        return duration
+    return Audio(path)
 
 
 class WaveformAudio:
@@ -0,0 +1,29 @@
+import argparse
+import logging
+
+from audio import open_audio
+from transcriptor import TranscriptionConfig, Transcriptor
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Пример: python bench_transcription.py call.wav whisper:large:fp32 faster-whisper:medium:int8:1 --language ru
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Real-time factor of transcription configs on this node")
+    parser.add_argument("audio")
+    parser.add_argument("configs", nargs="+", help="backend:model[:precision[:beam_size]]")
+    parser.add_argument("--language", default=None)
+    args = parser.parse_args()
+
+    audio = open_audio(args.audio)
+    report = []
+
+    for spec in args.configs:
+        config = TranscriptionConfig.parse(spec, args.language)
+        transcriptor = Transcriptor(config)
+        result = transcriptor.transcribe(audio)
+        report.append(result.stats)
+        transcriptor.cleanup()
+
+    print(f"{'config':<45} {'audio, s':>10} {'elapsed, s':>12} {'RTF':>8}")
+    for stats in sorted(report, key=lambda s: s["rtf"]):
+        print(f"{stats['config']:<45} {stats['audio_duration']:>10.1f} {stats['elapsed']:>12.1f} {stats['rtf']:>8.3f}")
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from importlib import metadata
+
+# Ключ видит версии библиотек и ревизии моделей, но не код этапов в этом репозитории:
+# после правки кода, меняющей результат этапа (нарезка, склейка, формат), CACHE_VERSION нужно увеличить
+CACHE_VERSION = 1
+
+
+# Версия установленного пакета для ключа кэша, без импорта самой библиотеки
+def package_version(name: str) -> str | None:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+# Кэш результатов этапов на локальном диске. Ключ - хэш содержимого входа и конфигурации этапа
+# (модель, версия, параметры), поэтому повторная отправка той же записи не пересчитывает
+# Whisper, диаризацию и эмбеддинги, а после правки промпта пересчитывается только LLM.
+# Когда кэш превышает max_bytes, удаляются давно не использованные записи (LRU по mtime)
+class StageCache:
+    def __init__(self, root: str = "cache", max_bytes: int = 5 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+        self.total = sum(os.path.getsize(p) for p, _ in self.entries())
+
+    @staticmethod
+    def from_env():
+        root = os.getenv("CACHE_DIR", "cache")
+        if not root:
+            return None
+
+        return StageCache(root, int(os.getenv("CACHE_MAX_BYTES", str(5 * 1024**3))))
+
+    @staticmethod
+    def key(stage: str, config: dict) -> str:
+        data = json.dumps({"version": CACHE_VERSION, "stage": stage, **config}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.root, stage, key[:2], f"{key}.pkl")
+
+    def entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(".pkl"):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        yield path, os.stat(path).st_mtime
+                    except OSError:
+                        pass
+
+    def get(self, stage: str, key: str):
+        path = self.path(stage, key)
+
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None, False
+        except Exception as e:
+            # битая или несовместимая запись (например, класс из нее переименован) удаляется и пересчитывается
+            logging.warning(f"Dropping unreadable cache entry {path}: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None, False
+
+        # отмечаем запись как недавно использованную
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return value, True
+
+    def put(self, stage: str, key: str, value):
+        path = self.path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # имя временного файла уникально и между потоками, и между процессами пула
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        except OSError as e:
+            logging.warning(f"Could not cache {stage}: {e}")
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f)
+
+            # перезапись существующей записи не должна увеличивать учтенный объем
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.warning(f"Could not cache {stage}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            self.total += os.path.getsize(path) - old_size
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        self.total = sum(os.path.getsize(p) for p, _ in entries)
+
+        for path, _ in entries:
+            if self.total <= self.max_bytes * 0.9:
+                break
+
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.total -= size
+            except OSError:
+                pass
+
+        logging.info(f"Cache evicted down to {self.total} bytes")
+
+    def get_or_compute(self, stage: str, key: str, compute):
+        value, hit = self.get(stage, key)
+        if hit:
+            logging.info(f"Cache hit: {stage}")
+            return value
+
+        value = compute()
+        self.put(stage, key, value)
+
+        return value
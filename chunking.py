@@ -0,0 +1,99 @@
+import numpy as np
+
+WHISPER_WINDOW = 30.0
+
+
+def merge_regions(regions: list[tuple[float, float]], gap: float = 0.5, pad: float = 0.2) -> list[tuple[float, float]]:
+    merged = []
+
+    for start, end in sorted(regions):
+        start, end = max(start - pad, 0.0), end + pad
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def regions_from_diarization(diarization) -> list[tuple[float, float]]:
+    return merge_regions([(turn.start, turn.end) for turn, _ in diarization.speaker_diarization])
+
+
+# Простой энергетический VAD: кадры по 30 мс, речью считаются кадры заметно громче фонового шума
+def energy_vad(audio, frame: float = 0.03, margin_db: float = 12.0, min_db: float = -50.0) -> list[tuple[float, float]]:
+    frame_len = int(frame * audio.sr)
+    energies = []
+
+    for _, chunk in audio.chunks():
+        samples = chunk[0].numpy()
+        frames = len(samples) // frame_len
+        if frames == 0:
+            continue
+        rms = np.sqrt(np.mean(samples[:frames * frame_len].reshape(frames, frame_len) ** 2, axis=1) + 1e-10)
+        energies.append(20 * np.log10(rms))
+
+    if not energies:
+        return []
+
+    db = np.concatenate(energies)
+    threshold = max(np.percentile(db, 10) + margin_db, min_db)
+    voiced = db > threshold
+
+    regions = []
+    start = None
+    for i, v in enumerate(voiced):
+        if v and start is None:
+            start = i
+        elif not v and start is not None:
+            regions.append((start * frame, i * frame))
+            start = None
+    if start is not None:
+        regions.append((start * frame, len(voiced) * frame))
+
+    return merge_regions(regions)
+
+
+# Кусок длиной до 30 с, склеенный из одного или нескольких участков речи.
+# pieces - (смещение внутри куска, начало в исходной записи, длина)
+class Chunk:
+    def __init__(self):
+        self.pieces: list[tuple[float, float, float]] = []
+        self.duration = 0.0
+
+    def add(self, start: float, end: float):
+        self.pieces.append((self.duration, start, end - start))
+        self.duration += end - start
+
+    # конец сегмента, попавший ровно на стык кусков, относится к предыдущему участку
+    def to_original(self, t: float, end: bool = False) -> float:
+        for offset, start, length in reversed(self.pieces):
+            if t > offset or (t == offset and not end):
+                return start + min(t - offset, length)
+
+        return self.pieces[0][1]
+
+    def samples(self, audio) -> np.ndarray:
+        return np.concatenate([audio.crop(start, start + length)[0].numpy() for _, start, length in self.pieces])
+
+
+def pack_regions(regions: list[tuple[float, float]], max_duration: float = WHISPER_WINDOW) -> list[Chunk]:
+    chunks = []
+    current = Chunk()
+
+    for start, end in regions:
+        while end - start > 0:
+            room = max_duration - current.duration
+            if room <= 0.5:
+                chunks.append(current)
+                current = Chunk()
+                room = max_duration
+
+            piece_end = min(end, start + room)
+            current.add(start, piece_end)
+            start = piece_end
+
+    if current.pieces:
+        chunks.append(current)
+
+    return chunks
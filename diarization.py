@@ -5,17 +5,18 @@ from audio import Audio
 
 
 class Diarization:
-    def __init__(self, model: str, tk: str):
+    def __init__(self, model: str, tk: str, revision: str = "main"):
         pipeline = Pipeline.from_pretrained(
             model,
             token=tk,
-            revision="main",
+            revision=revision,
         )
 
         if pipeline is None:
             raise RuntimeError("Could not initialize the pipeline")
 
         self.pipeline = pipeline
+        self.model = model
 
     def diarize(self, audio: Audio):
         return self.pipeline(audio())
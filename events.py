@@ -0,0 +1,169 @@
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import socket
+from urllib.parse import urlsplit
+
+import httpx
+
+
+class WebhookError(RuntimeError):
+    pass
+
+
+def format_sse(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False, default=str)}\n\n"
+
+
+# События задач рассылаются подписчикам (SSE) и на webhook. Воркеры публикуют из своих потоков,
+# а вся работа с очередями подписчиков идет в цикле событий сервера через call_soon_threadsafe.
+# Пока задача не завершена, ее события копятся в history, чтобы поздний подписчик получил их все
+class EventBus:
+    def __init__(self, webhook_retries: int = 3, webhook_timeout: float = 10.0, allowed_hosts: set[str] | None = None):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # если список задан, webhook отправляется только на эти хосты (в том числе внутренние)
+        self.allowed_hosts = allowed_hosts
+        self.subscribers: dict[str, set[asyncio.Queue]] = {}
+        self.history: dict[str, list[dict]] = {}
+        self.callbacks: dict[str, str] = {}
+        self.webhook_retries = webhook_retries
+        self.webhook_timeout = webhook_timeout
+        self.http: httpx.AsyncClient | None = None
+
+    @staticmethod
+    def from_env():
+        hosts = os.getenv("WEBHOOK_ALLOWED_HOSTS")
+
+        return EventBus(
+            int(os.getenv("WEBHOOK_RETRIES", "3")),
+            float(os.getenv("WEBHOOK_TIMEOUT", "10")),
+            {host.strip().lower() for host in hosts.split(",") if host.strip()} if hosts else None,
+        )
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.http = httpx.AsyncClient(timeout=self.webhook_timeout)
+
+    # вызывается из цикла событий при постановке задачи
+    def open(self, task_id: str, callback_url: str | None = None):
+        self.history[task_id] = []
+        if callback_url:
+            self.callbacks[task_id] = callback_url
+
+    def active(self, task_id: str) -> bool:
+        return task_id in self.history
+
+    # потокобезопасно, вызывается из воркеров
+    def publish(self, task_id: str, event: str, data: dict | None = None):
+        if self.loop is None:
+            return
+
+        self.loop.call_soon_threadsafe(self.dispatch, task_id, {"event": event, "data": data or {}})
+
+    def dispatch(self, task_id: str, event: dict):
+        for q in self.subscribers.get(task_id, ()):
+            q.put_nowait(event)
+
+        if event["event"] != "done":
+            self.history.setdefault(task_id, []).append(event)
+            return
+
+        self.history.pop(task_id, None)
+        url = self.callbacks.pop(task_id, None)
+        if url is not None:
+            asyncio.ensure_future(self.deliver(url, task_id, event["data"]))
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        q = asyncio.Queue()
+        for event in self.history.get(task_id, ()):
+            q.put_nowait(event)
+
+        self.subscribers.setdefault(task_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, task_id: str, q: asyncio.Queue):
+        subscribers = self.subscribers.get(task_id)
+        if subscribers is None:
+            return
+
+        subscribers.discard(q)
+        if not subscribers:
+            del self.subscribers[task_id]
+
+    # Сервер не должен ходить по адресу из запроса во внутреннюю сеть (SSRF), поэтому без списка
+    # разрешенных хостов все адреса, в которые разрешается имя, должны быть публичными:
+    # не loopback, не link-local (в том числе метаданные облака) и не частные сети.
+    # Возвращает проверенный адрес, к которому и нужно подключаться (None для хостов из списка)
+    async def check_url(self, url: str) -> str | None:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise WebhookError("callback_url must be an http(s) URL")
+
+        if self.allowed_hosts is not None:
+            if parts.hostname.lower() not in self.allowed_hosts:
+                raise WebhookError(f"callback host {parts.hostname} is not allowed")
+            return None
+
+        try:
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            addresses = await asyncio.get_running_loop().getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+        except (OSError, ValueError) as e:
+            raise WebhookError(f"could not resolve callback host {parts.hostname}: {e}")
+
+        for *_, sockaddr in addresses:
+            address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+            if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+                address = address.ipv4_mapped
+            if not address.is_global:
+                raise WebhookError(f"callback host {parts.hostname} resolves to a non-public address")
+
+        return addresses[0][4][0].split("%")[0]
+
+    # Запрос идет на уже проверенный адрес, а не на имя: иначе httpx разрешил бы имя заново,
+    # и между проверкой и подключением оно могло бы смениться на внутренний адрес (DNS rebinding).
+    # Имя хоста остается в заголовке Host и в SNI, по нему же проверяется сертификат
+    async def post(self, url: str, address: str | None, body: str) -> httpx.Response:
+        headers = {"Content-Type": "application/json"}
+        if address is None:
+            return await self.http.post(url, content=body, headers=headers) # type: ignore
+
+        target = httpx.URL(url)
+        request = self.http.build_request( # type: ignore
+            "POST",
+            target.copy_with(host=address),
+            content=body,
+            headers={**headers, "Host": target.netloc.decode("ascii")},
+            extensions={"sni_hostname": target.raw_host.decode("ascii")},
+        )
+        return await self.http.send(request) # type: ignore
+
+    async def deliver(self, url: str, task_id: str, data: dict):
+        body = json.dumps({"task_id": task_id, **data}, ensure_ascii=False, default=str)
+
+        for attempt in range(self.webhook_retries + 1):
+            # адрес проверяется заново перед каждой попыткой: имя могло начать разрешаться во внутренний адрес
+            try:
+                address = await self.check_url(url)
+            except WebhookError as e:
+                logging.warning(f"Webhook for task {task_id} not sent: {e}")
+                return
+
+            try:
+                response = await self.post(url, address, body)
+                if response.status_code < 500:
+                    if response.status_code >= 400:
+                        logging.warning(f"Webhook {url} rejected task {task_id}: {response.status_code}")
+                    return
+                error = f"status {response.status_code}"
+            except httpx.HTTPError as e:
+                error = str(e)
+
+            logging.warning(f"Webhook {url} for task {task_id} failed (attempt {attempt + 1}): {error}")
+            if attempt < self.webhook_retries:
+                await asyncio.sleep(2 ** attempt)
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
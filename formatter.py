@@ -1,20 +1,112 @@
+import bisect
+import itertools
+
 from transcriptor import TranscriptorResult
 
 
-def format_dialogue(diarization, transcription: TranscriptorResult) -> list:
-    dialogue = []
-    used_segments = set()
+class IntervalIndex:
+    def __init__(self, intervals: list[tuple[float, float]]):
+        self.order = sorted(range(len(intervals)), key=lambda i: intervals[i][0])
+        self.starts = [intervals[i][0] for i in self.order]
+        self.ends = [intervals[i][1] for i in self.order]
+        # максимум концов среди всех интервалов, начавшихся не позже текущего
+        self.max_ends = list(itertools.accumulate(self.ends, max))
 
-    for turn, speaker in diarization.speaker_diarization:
-        texts_in_turn = []
-        for segment in transcription.segments:
-            if segment["end"] > turn.start and segment["start"] < turn.end: # type: ignore
-                seg_text = segment["text"].strip() # type: ignore
-                if seg_text not in used_segments:
-                    texts_in_turn.append(seg_text)
-                    used_segments.add(seg_text)
+    def overlapping(self, start: float, end: float):
+        lo = bisect.bisect_right(self.max_ends, start)
+        hi = bisect.bisect_left(self.starts, end)
+
+        for pos in range(lo, hi):
+            if self.ends[pos] > start:
+                yield self.order[pos]
+
+    # ближайший интервал к отрезку, который ни с одним интервалом не пересекается
+    def nearest(self, start: float, end: float) -> int | None:
+        if not self.starts:
+            return None
+
+        after = bisect.bisect_left(self.starts, end)
+        best, distance = None, float("inf")
+
+        if after < len(self.starts):
+            best, distance = after, self.starts[after] - end
 
+        if after > 0:
+            # интервал с наибольшим концом среди начавшихся раньше - первая позиция, где достигается этот максимум
+            before = bisect.bisect_left(self.max_ends, self.max_ends[after - 1], 0, after)
+            if start - self.ends[before] <= distance:
+                best = before
+
+        return self.order[best] # type: ignore
+
+
+def format_dialogue(diarization, transcription: TranscriptorResult, words: bool = False) -> list:
+    turns = list(diarization.speaker_diarization)
+
+    if words and all("words" in segment for segment in transcription.segments):
+        texts = align_words(turns, transcription)
+    else:
+        texts = align_segments(turns, transcription)
+
+    dialogue = []
+
+    for (turn, speaker), texts_in_turn in zip(turns, texts):
         if texts_in_turn:
             dialogue.append(f"{speaker} [{turn.start}, {turn.end}]: {' '.join(texts_in_turn)}")
 
     return dialogue
+
+
+# сегмент Whisper достается первой реплике, с которой он пересекается
+def align_segments(turns, transcription: TranscriptorResult) -> list[list[str]]:
+    segments = transcription.segments
+    index = IntervalIndex([(s["start"], s["end"]) for s in segments]) # type: ignore
+    used_segments = set()
+    texts = []
+
+    for turn, _ in turns:
+        texts_in_turn = []
+
+        for i in sorted(index.overlapping(turn.start, turn.end)):
+            if i in used_segments:
+                continue
+
+            used_segments.add(i)
+            seg_text = segments[i]["text"].strip() # type: ignore
+            if seg_text:
+                texts_in_turn.append(seg_text)
+
+        texts.append(texts_in_turn)
+
+    return texts
+
+
+# каждое слово достается реплике, с которой у него наибольшее пересечение,
+# поэтому сегмент, на который пришлась смена спикера, делится между ними.
+# Слово в паузе между репликами достается ближайшей из них, а не теряется
+def align_words(turns, transcription: TranscriptorResult) -> list[list[str]]:
+    index = IntervalIndex([(turn.start, turn.end) for turn, _ in turns])
+    words_by_turn = [[] for _ in turns]
+
+    for segment in transcription.segments:
+        for word in segment["words"]: # type: ignore
+            best, best_overlap = None, 0.0
+
+            for i in index.overlapping(word["start"], word["end"]):
+                turn = turns[i][0]
+                overlap = min(turn.end, word["end"]) - max(turn.start, word["start"])
+                if best is None or overlap > best_overlap:
+                    best, best_overlap = i, overlap
+
+            if best is None:
+                best = index.nearest(word["start"], word["end"])
+
+            if best is not None:
+                words_by_turn[best].append(word["word"])
+
+    texts = []
+    for words in words_by_turn:
+        text = "".join(words).strip()
+        texts.append([text] if text else [])
+
+    return texts
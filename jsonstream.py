@@ -0,0 +1,120 @@
+import json
+
+
+# Инкрементальный разбор JSON-объекта, который модель генерирует по кусочкам.
+# Поля верхнего уровня отдаются в on_field, как только их значение закончилось,
+# а done становится True, как только закрылась внешняя фигурная скобка,
+# так что генерацию можно прервать, не дожидаясь, пока модель допишет что-то после JSON
+class IncrementalJsonParser:
+    def __init__(self, on_field=None, max_preamble: int = 200):
+        self.on_field = on_field
+        self.max_preamble = max_preamble
+
+        self.buffer = ""
+        self.pos = 0
+        self.start: int | None = None
+        self.end: int | None = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+        self.expect_key = False
+        self.key = None
+        self.key_start: int | None = None
+        self.value_start: int | None = None
+
+        self.fields = {}
+        self.done = False
+        self.invalid = False
+        self.error: str | None = None
+
+    def feed(self, text: str) -> bool:
+        self.buffer += text
+
+        while self.pos < len(self.buffer) and not self.done and not self.invalid:
+            self.step(self.buffer[self.pos])
+            self.pos += 1
+
+        # до начала объекта допускается только небольшая преамбула (например, ```json)
+        if self.start is None and len(self.buffer.strip()) > self.max_preamble:
+            self.invalid = True
+            self.error = "no JSON object in the response"
+
+        return self.done or self.invalid
+
+    def step(self, c: str):
+        i = self.pos
+
+        if self.start is None:
+            if c == "{":
+                self.start = i
+                self.depth = 1
+                self.expect_key = True
+            return
+
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif c == "\\":
+                self.escape = True
+            elif c == '"':
+                self.in_string = False
+                if self.depth == 1 and self.expect_key:
+                    self.key = json.loads(self.buffer[self.key_start:i + 1])
+            return
+
+        if c == '"':
+            self.in_string = True
+            if self.depth == 1 and self.expect_key:
+                # второй ключ подряд без двоеточия
+                if self.key is not None:
+                    self.reject("missing ':' after key")
+                self.key_start = i
+        elif c in "{[":
+            self.depth += 1
+        elif c in "}]":
+            self.depth -= 1
+            if self.depth == 0:
+                self.emit(i)
+                self.done = not self.invalid
+                self.end = i + 1
+        elif c == ":" and self.depth == 1:
+            # двоеточие там, где ждали значение: между полями пропущена запятая
+            if not self.expect_key or self.key is None:
+                self.reject("missing ',' between fields")
+                return
+            self.expect_key = False
+            self.value_start = i + 1
+        elif c == "," and self.depth == 1:
+            self.emit(i)
+            self.expect_key = True
+
+    def reject(self, error: str):
+        self.invalid = True
+        self.error = f"{error} at {self.pos}"
+
+    def emit(self, i: int):
+        if self.key is None or self.value_start is None:
+            return
+
+        raw = self.buffer[self.value_start:i].strip()
+
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError as e:
+            self.invalid = True
+            self.error = f"invalid value for {self.key}: {e}"
+            return
+
+        self.fields[self.key] = value
+        if self.on_field is not None:
+            self.on_field(self.key, value)
+
+        self.key = None
+        self.value_start = None
+
+    def text(self) -> str:
+        if self.start is None:
+            return self.buffer
+
+        return self.buffer[self.start:self.end]
@@ -1,10 +1,16 @@
+import asyncio
+import hashlib
 import json
 import logging
+import re
 
-import requests
-
+from llm_client import AsyncOllamaClient, Prompt, get_client
 from regex_filter import FilteringString, RegexFilter
+from schema import FINAL_SCHEMA, REGULAR_SCHEMA, SEGMENT_SCHEMA, validator_for
+from tokens import TokenCounter, approx_tokens
 
+# Инструкция и описание формата не меняются от звонка к звонку, поэтому уходят в system-промпт:
+# Ollama держит его префикс в KV-кэше, и заново обрабатывать приходится только входные данные
 __LLM_INSTRUCTION ="""
 Роль: Ты — AI-анализатор безопасности, специализирующийся на выявлении мошеннических и подозрительных паттернов в телефонных разговорах. Твоя задача — проанализировать предоставленный текст звонка и присвоить ему одну из трёх категорий: мошеннический, подозрительный или обычный.
 
@@ -55,7 +61,7 @@ segment_risk_score - число от 0 до 10.
 """
 
 def generate_regular_prompt(dialogue: list[str], call_number: int, ksv: list[str]):
-    return __LLM_INSTRUCTION + """Инструкция:
+    return Prompt(__LLM_INSTRUCTION + """Инструкция:
     Проанализируй предоставленный ниже текст транскрипта телефонного звонка. Опирайся исключительно на текст. Присвой звонку одну из трёх категорий: МОШЕННИЧЕСКИЙ, ПОДОЗРИТЕЛЬНЫЙ или ОБЫЧНЫЙ.
 
     Формат входных данных:
@@ -97,19 +103,16 @@ def generate_regular_prompt(dialogue: list[str], call_number: int, ksv: list[str
     }
     ВАЖНО: Вывод строго соответствует схеме JSON. Никаких дополнительных полей, вложенных объектов, или советов давать нельзя. Так же нельзя переименовывать поля, переводить их на русский язык и так далее. Схема должна быть строго такой
     Выходные данные будут обрабатываться программой, поэтому любые отличия от этой схемы приведут к ошибке
-
-    Входные данные:
-    """ + json.dumps({
+    """, "Входные данные: " + json.dumps({
         "dialogue": dialogue,
         "call_number": call_number,
         "known_scammers_voice": ksv
-    }, ensure_ascii=False)
+    }, ensure_ascii=False), REGULAR_SCHEMA)
 
 
 def generate_segment_propmt(prev_summary: str | None, segment: list[str], segment_num: int, segment_count: int):
-    s = __LLM_INSTRUCTION + """
+    system = __LLM_INSTRUCTION + """
     Поскольку звонок слишком большой, мы разбили его на сегменты
-    Это сегмент {segment_num} из {segment_count}
 
     Твоя задача - сгенерировать короткое описание этого сегмента диалога. Учти, что твоя конечная цель - определить, является
     ли этот звонок мошенническим, поэтому имеет смысл добавлять в сводку только то, что может помочь при принятии этого решения
@@ -146,22 +149,17 @@ def generate_segment_propmt(prev_summary: str | None, segment: list[str], segmen
     НЕ добавляй вступления.
     Если формат нарушен — система завершит процесс.
     ТВОЙ ОТВЕТ ДОЛЖЕН БЫТЬ *ТОЛЬКО JSON*.
-
-
-    Входные данные: {input_string}
-
     """
-    s = s.replace("{segment_num}", str(segment_num))
-    s = s.replace("{segment_count}", str(segment_count))
-    s = s.replace("{input_string}", json.dumps({
+
+    user = f"Это сегмент {segment_num} из {segment_count}\n\nВходные данные: " + json.dumps({
         "prev_summary": prev_summary,
         "segment": segment
-    }, ensure_ascii=False))
+    }, ensure_ascii=False)
 
-    return s
+    return Prompt(system, user, SEGMENT_SCHEMA)
 
 def generate_final_segment_propmt(prev_summary: str | None, segment: list[str], call_number: int, ksv: list[str], prev_risc_scores: list[int], prev_scammers: list[str]):
-    s = __LLM_INSTRUCTION + """
+    system = __LLM_INSTRUCTION + """
 
     Поскольку звонок слишком большой, мы разбили его на сегменты
     Это последний сегмент, и тут тебе нужно принять решение, является ли звонок мошенническим
@@ -220,61 +218,193 @@ def generate_final_segment_propmt(prev_summary: str | None, segment: list[str],
     НЕ добавляй вступления.
     Если формат нарушен — система завершит процесс.
     ТВОЙ ОТВЕТ ДОЛЖЕН БЫТЬ *ТОЛЬКО JSON*.
-
-    Входные данные: {input_string}
     """
 
-    s = s.replace("{input_string}", json.dumps({
+    user = "Входные данные: " + json.dumps({
         "call_number": call_number,
         "prev_summary": prev_summary,
         "segment": segment,
         "known_scammers_voice": ksv,
         "prev_risk_scores": prev_risc_scores,
         "prev_scammers": prev_scammers
-    }, ensure_ascii=False))
+    }, ensure_ascii=False)
+
+    return Prompt(system, user, FINAL_SCHEMA)
+
+def generate_reduce_prompt(summaries: list[str | None], call_number: int, ksv: list[str], risk_scores: list[int], scammers: list[str]):
+    system = __LLM_INSTRUCTION + """
+
+    Поскольку звонок слишком большой, мы разбили его на сегменты и проанализировали каждый сегмент отдельно
+    Теперь тебе нужно объединить результаты анализа всех сегментов и принять решение, является ли звонок мошенническим
+
+    Формат входных данных:
+
+    {
+        "call_number": number,
+        "segment_summaries": [string | null],
+        "segment_risk_scores": [number],
+        "known_scammers_voice": [string],
+        "segment_scammers": [string]
+    }
+
+    call_number - номер звонка
+
+    segment_summaries - краткие описания сегментов в порядке их следования в звонке. null означает, что в сегменте не было ничего, на что стоит обратить внимание
+
+    segment_risk_scores - риск-скоры сегментов в том же порядке. Риск-скор - это число от 0 до 10, где 0 значит, что в этом сегменте вообще нет признаков социальной инженерии, а 10 - что этот сегмент содержит неопровержимые доказательства попытки обмана.
+    Наибольшее внимание стоит обращать на сегменты, где риск-скор высокий, поскольку в сегментах, где он низкий, говорящие могли просто здороваться, или обсужадть что-то несвязанное
+
+    known_scammers_voice - если голос, похожий на голос одного или нескольких спикеров есть в базе данных известных нам мошенников, то они будут перечислены тут. Это НЕ 100% доказательство, но может добавлять вес. Пример: [SPEAKER_01, SPEAKER_00]
+
+    segment_scammers - спикеры, которых ты подозревал в мошенничестве хотя бы в одном из сегментов
+
+    Формат выходных данных:
 
-    return s
+    {
+        "call_number": number,
+        "category": "normal" | "suspicious" | "fraudulent",
+        "summary": string,
+        "risk_score": number,
+        "indicators": [string]
+        "scammers": [string]
+    }
+
+    call_number - номер звонка, тот же что и у запроса
+
+    category - категория звонка
+
+    summary - общее описание всего звонка
+
+    risk_score - риск-скор всего звонка
 
-# сегментация нужна, потому что на очень больших входных данных LLM не хватает контекста, и она выдает невалидный результат
-def split_dialogue_into_segments(dialogue: list[str], max_segment_size: int = 4500) -> list[list[str]]:
+    indicators - индикаторы мошенничества, могут быть взяты из описаний сегментов
+
+    scammers - спикеры, являющиеся мошенниками (например, [SPEAKER_00, SPEAKER_01])
+
+    !!! ВАЖНО !!!
+    Ответь строго в формате JSON, без текста до или после.
+    НЕ добавляй объяснения.
+    НЕ добавляй рассуждения.
+    НЕ добавляй вступления.
+    Если формат нарушен — система завершит процесс.
+    ТВОЙ ОТВЕТ ДОЛЖЕН БЫТЬ *ТОЛЬКО JSON*.
+    """
+
+    user = "Входные данные: " + json.dumps({
+        "call_number": call_number,
+        "segment_summaries": summaries,
+        "segment_risk_scores": risk_scores,
+        "known_scammers_voice": ksv,
+        "segment_scammers": scammers
+    }, ensure_ascii=False)
+
+    return Prompt(system, user, FINAL_SCHEMA)
+
+# хэш неизменной части всех промптов, меняется при любой правке инструкции или формата
+def prompt_fingerprint() -> str:
+    prompts = [
+        generate_regular_prompt([], 0, []),
+        generate_segment_propmt(None, [], 1, 1),
+        generate_final_segment_propmt(None, [], 0, [], [], []),
+        generate_reduce_prompt([], 0, [], [], []),
+    ]
+
+    return hashlib.sha256("".join(p.system for p in prompts).encode()).hexdigest()
+
+# сегментация нужна, потому что на очень больших входных данных LLM не хватает контекста, и она выдает невалидный результат.
+# Размер сегмента считается в токенах: окно контекста минус инструкция и запас под ответ
+class Segmentation:
+    def __init__(self, context_window: int = 8192, output_tokens: int = 1024, overlap_tokens: int = 0, counter: TokenCounter | None = None):
+        self.context_window = context_window
+        self.output_tokens = output_tokens
+        self.overlap_tokens = overlap_tokens
+        self.counter = counter or TokenCounter()
+        self.static_tokens = None
+
+    def count(self, text: str) -> int:
+        return self.counter.count(text)
+
+    # строка диалога уходит в промпт как элемент JSON-массива: с кавычками, экранированием и запятой
+    def line_tokens(self, line: str) -> int:
+        return self.count(json.dumps(line, ensure_ascii=False)) + 1
+
+    def prompt_tokens(self) -> tuple[int, int]:
+        if self.static_tokens is None:
+            regular = self.count(str(generate_regular_prompt([], 0, [])))
+            segmented = max(
+                self.count(str(generate_segment_propmt(None, [], 1, 1))),
+                self.count(str(generate_final_segment_propmt(None, [], 0, [], [], []))),
+            )
+            self.static_tokens = (regular, segmented)
+
+        return self.static_tokens
+
+    def regular_budget(self) -> int:
+        return self.context_window - self.prompt_tokens()[0] - self.output_tokens
+
+    # в сегментированном режиме во входных данных есть еще сводка предыдущих сегментов,
+    # под нее оставляем столько же, сколько под ответ
+    def segment_budget(self) -> int:
+        return self.context_window - self.prompt_tokens()[1] - 2 * self.output_tokens
+
+    def fits(self, dialogue: list[str]) -> bool:
+        return sum(self.line_tokens(line) for line in dialogue) <= self.regular_budget()
+
+    def split(self, dialogue: list[str]) -> list[list[str]]:
+        return split_dialogue_into_segments(dialogue, self.segment_budget(), self.line_tokens, self.overlap_tokens)
+
+
+def split_dialogue_into_segments(dialogue: list[str], max_segment_tokens: int, count_tokens=approx_tokens, overlap_tokens: int = 0) -> list[list[str]]:
     segments = []
     curr_segment = []
     curr_len = 0
 
+    def overlap(segment: list[str]) -> tuple[list[str], int]:
+        tail, tail_len = [], 0
+        for line in reversed(segment):
+            line_len = count_tokens(line)
+            if tail_len + line_len > overlap_tokens:
+                break
+            tail.insert(0, line)
+            tail_len += line_len
+        return tail, tail_len
+
     for dseg in dialogue:
-        seg_len = len(dseg)
+        seg_len = count_tokens(dseg)
 
-        if seg_len > max_segment_size:
+        if seg_len > max_segment_tokens:
             if curr_segment:
                 segments.append(curr_segment)
-                curr_segment = []
-                curr_len = 0
             segments.append([dseg])
             curr_segment = []
             curr_len = 0
             continue
 
-        if curr_len + seg_len <= max_segment_size:
+        if curr_len + seg_len <= max_segment_tokens:
             curr_segment.append(dseg)
             curr_len += seg_len
         else:
             segments.append(curr_segment)
-            curr_segment = [dseg]
-            curr_len = seg_len
+            # конец предыдущего сегмента повторяется в начале следующего, чтобы не терять контекст на стыке
+            curr_segment, curr_len = overlap(curr_segment)
+            if curr_len + seg_len > max_segment_tokens:
+                curr_segment, curr_len = [], 0
+            curr_segment.append(dseg)
+            curr_len += seg_len
 
     if curr_segment:
         segments.append(curr_segment)
 
     return segments
 
-def send_reqular_request(dialogue: list[str], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3"):
+def send_reqular_request(dialogue: list[str], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3", on_field=None):
     prompt = generate_regular_prompt(dialogue, call_number, ksv)
 
     logging.debug(f"REGULAR PROMPT: {prompt}")
 
-    return send_request(prompt, ollama_server, model)
+    return request_json(prompt, ollama_server, model, on_field)
 
-def send_segmented_request(segments: list[list[str]], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3"):
+def send_segmented_request(segments: list[list[str]], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3", on_field=None, on_segment=None):
     segments_count = len(segments)
     prev_summary = None
     risk_scores = []
@@ -283,40 +413,159 @@ def send_segmented_request(segments: list[list[str]], call_number: int, ksv: lis
     for i in range(segments_count-1):
         prompt = generate_segment_propmt(prev_summary, segments[i], i+1, segments_count)
         logging.debug(f"SEGMENT PROMPT: {i}: {prompt}")
-        resp = FilteringString(send_request(prompt, ollama_server, model)["response"]).filter(RegexFilter.md_json())
+        parsed = request_json(prompt, ollama_server, model)
 
-        logging.debug(f"SEGMENT RESPONSE: {i}: {resp}")
-
-        parsed = json.loads(str(resp))
+        logging.debug(f"SEGMENT RESPONSE: {i}: {parsed}")
 
         prev_summary = parsed["summary"]
         risk_scores.append(parsed["segment_risk_score"])
         scammers.update(parsed["scammers"])
 
-    return send_final_segmented_request(prev_summary, risk_scores, list(scammers), segments[segments_count-1], call_number, ksv, ollama_server, model)
+        if on_segment is not None:
+            on_segment(i+1, segments_count)
+
+    result = send_final_segmented_request(prev_summary, risk_scores, list(scammers), segments[segments_count-1], call_number, ksv, ollama_server, model, on_field)
 
-def send_final_segmented_request(prev_summary: str | None, prev_risk_scores: list[int], prev_scammers: list[str], segment: list[str], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3"):
+    if on_segment is not None:
+        on_segment(segments_count, segments_count)
+
+    return result
+
+def send_final_segmented_request(prev_summary: str | None, prev_risk_scores: list[int], prev_scammers: list[str], segment: list[str], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3", on_field=None):
     prompt = generate_final_segment_propmt(prev_summary, segment, call_number, ksv, prev_risk_scores, prev_scammers)
     logging.debug(f"FINAL SEGMENT PROMPT: {prompt}")
 
-    return send_request(prompt, ollama_server, model)
+    return request_json(prompt, ollama_server, model, on_field)
+
+# Каждый сегмент анализируется независимо и параллельно (map), затем отдельный запрос
+# объединяет результаты (reduce). В отличие от последовательного режима, сегменты не ждут друг друга
+def send_map_reduce_request(segments: list[list[str]], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3", concurrency: int = 4, on_field=None, on_segment=None):
+    parsed = asyncio.run(analyze_segments_concurrently(segments, ollama_server, model, concurrency, on_segment))
+
+    summaries = [p["summary"] for p in parsed]
+    risk_scores = [p["segment_risk_score"] for p in parsed]
+    scammers = sorted({sp for p in parsed for sp in p["scammers"]})
+
+    prompt = generate_reduce_prompt(summaries, call_number, ksv, risk_scores, scammers)
+    logging.debug(f"REDUCE PROMPT: {prompt}")
+
+    return request_json(prompt, ollama_server, model, on_field)
+
+# on_segment получает число уже готовых сегментов, порядок их завершения не гарантирован
+async def analyze_segments_concurrently(segments: list[list[str]], ollama_server, model: str | None, concurrency: int, on_segment=None) -> list[dict]:
+    segments_count = len(segments)
+    finished = 0
+
+    async with AsyncOllamaClient(get_client(ollama_server), concurrency) as client:
+        async def analyze_segment(i: int):
+            prompt = generate_segment_propmt(None, segments[i], i+1, segments_count)
+            logging.debug(f"MAP SEGMENT PROMPT: {i}: {prompt}")
+            parsed = await request_json_async(prompt, client, model)
+
+            logging.debug(f"MAP SEGMENT RESPONSE: {i}: {parsed}")
+
+            nonlocal finished
+            finished += 1
+            if on_segment is not None:
+                on_segment(finished, segments_count)
 
-def analyze_with_llm(dialogue: list[str], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3"):
-    segments = split_dialogue_into_segments(dialogue)
+            return parsed
+
+        return await asyncio.gather(*(analyze_segment(i) for i in range(segments_count)))
+
+def analyze_with_llm(dialogue: list[str], call_number: int, ksv: list[str], ollama_server, model: str | None = "ilyagusev/saiga_llama3", mode: str = "chained", concurrency: int = 4, on_field=None, on_segment=None, segmentation: Segmentation | None = None):
+    segmentation = segmentation or Segmentation()
+
+    if segmentation.fits(dialogue):
+        return send_reqular_request(dialogue, call_number, ksv, ollama_server, model, on_field)
+
+    segments = segmentation.split(dialogue)
 
     if len(segments) == 1:
-        return send_reqular_request(dialogue, call_number, ksv, ollama_server, model)
+        return send_reqular_request(dialogue, call_number, ksv, ollama_server, model, on_field)
+
+    if mode == "map_reduce":
+        return send_map_reduce_request(segments, call_number, ksv, ollama_server, model, concurrency, on_field, on_segment)
+
+    return send_segmented_request(segments, call_number, ksv, ollama_server, model, on_field, on_segment)
+
+# on_field вызывается для каждого готового поля ответа, пока модель еще генерирует остальные (только при LLM_STREAM=1)
+def send_request(prompt, ollama_server, model: str | None = "ilyagusev/saiga_llama3", on_field=None):
+    client = get_client(ollama_server)
+
+    if client.stream:
+        return client.stream_generate(prompt, model, on_field=on_field)
+
+    return client.generate(prompt, model)
+
+
+class LlmOutputError(RuntimeError):
+    pass
+
+
+def repair_candidates(text: str):
+    yield text
+
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        inner = text[start:end+1]
+        yield inner
+        yield re.sub(r",\s*([}\]])", r"\1", inner)
+
+# Сначала пробуем дешево починить ответ на месте (markdown, текст вокруг JSON, висячие запятые),
+# и только потом проверяем его по схеме
+def parse_response(text: str, schema: dict | None) -> tuple[dict | None, list[str]]:
+    text = str(FilteringString(text).filter(RegexFilter.md_json()))
+    errors = []
+
+    for candidate in repair_candidates(text):
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError as e:
+            errors = [f"invalid JSON: {e}"]
+            continue
+
+        if schema is None:
+            return parsed, []
+
+        return parsed, validator_for(schema)(parsed)
+
+    return None, errors
+
+def repair_prompt(prompt: Prompt, errors: list[str]) -> Prompt:
+    return Prompt(prompt.system, prompt.user + """
+
+    Твой предыдущий ответ не прошел проверку: """ + "; ".join(errors[:10]) + """
+    Ответь заново строго в формате JSON по схеме, без текста до или после.""", prompt.schema)
+
+# Если ответ не прошел проверку, повторяется только этот запрос (с описанием ошибок), а не весь анализ
+def request_json(prompt: Prompt, ollama_server, model: str | None = "ilyagusev/saiga_llama3", on_field=None) -> dict:
+    retries = get_client(ollama_server).repair_retries
+    current = prompt
+
+    for attempt in range(retries + 1):
+        res = send_request(current, ollama_server, model, on_field)
+        parsed, errors = parse_response(res["response"], prompt.schema)
+
+        if not errors:
+            return parsed # type: ignore
+
+        logging.warning(f"LLM response failed validation ({attempt+1}/{retries+1}): {errors}")
+        current = repair_prompt(prompt, errors)
+
+    raise LlmOutputError(f"LLM response does not match the schema: {errors}") # type: ignore
+
+async def request_json_async(prompt: Prompt, client: AsyncOllamaClient, model: str | None = "ilyagusev/saiga_llama3") -> dict:
+    current = prompt
+
+    for attempt in range(client.repair_retries + 1):
+        res = await client.generate(current, model)
+        parsed, errors = parse_response(res["response"], prompt.schema)
 
-    return send_segmented_request(segments, call_number, ksv, ollama_server, model)
+        if not errors:
+            return parsed # type: ignore
 
-def send_request(prompt, ollama_server, model: str | None = "ilyagusev/saiga_llama3"):
-    OLLAMA_GENERATE_PATH = "api/generate"
-    resp = requests.post(f"{ollama_server}/{OLLAMA_GENERATE_PATH}", json={
-        "model": model,
-        "prompt": prompt,
-        "stream": False,
-        "options":  {"temperature": 0}
-    }, verify=False)
+        logging.warning(f"LLM response failed validation ({attempt+1}/{client.repair_retries+1}): {errors}")
+        current = repair_prompt(prompt, errors)
 
-    res = resp.json()
-    return res
+    raise LlmOutputError(f"LLM response does not match the schema: {errors}") # type: ignore
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from jsonstream import IncrementalJsonParser
+
+OLLAMA_GENERATE_PATH = "api/generate"
+
+
+class OllamaError(RuntimeError):
+    pass
+
+
+# system - неизменная часть промпта (инструкция и формат ответа), user - данные конкретного звонка.
+# Пока system совпадает, Ollama переиспользует уже посчитанный для него KV-кэш
+class Prompt:
+    def __init__(self, system: str, user: str, schema: dict | None = None):
+        self.system = system
+        self.user = user
+        # JSON-схема ответа, передается в Ollama как format, чтобы декодирование шло строго по схеме
+        self.schema = schema
+
+    def __str__(self):
+        return self.system + self.user
+
+
+def build_payload(prompt: Prompt | str, model: str | None, options: dict | None, stream: bool, keep_alive: str | None, num_ctx: int | None = None, structured: bool = False) -> dict:
+    options = dict(options or {"temperature": 0})
+    if num_ctx is not None:
+        options.setdefault("num_ctx", num_ctx)
+
+    payload = {
+        "model": model,
+        "stream": stream,
+        "options": options
+    }
+
+    if isinstance(prompt, Prompt):
+        payload["system"] = prompt.system
+        payload["prompt"] = prompt.user
+        if structured and prompt.schema is not None:
+            payload["format"] = prompt.schema
+    else:
+        payload["prompt"] = prompt
+
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+
+    return payload
+
+
+class LlmMetrics:
+    def __init__(self, res: dict, latency: float, attempts: int):
+        self.latency = latency
+        self.attempts = attempts
+        self.prompt_tokens = res.get("prompt_eval_count", 0)
+        self.output_tokens = res.get("eval_count", 0)
+        # Ollama отдает длительности в наносекундах
+        self.total_duration = res.get("total_duration", 0) / 1e9
+        self.load_duration = res.get("load_duration", 0) / 1e9
+        self.prompt_duration = res.get("prompt_eval_duration", 0) / 1e9
+        self.eval_duration = res.get("eval_duration", 0) / 1e9
+
+    def tokens_per_second(self) -> float:
+        return self.output_tokens / self.eval_duration if self.eval_duration else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "attempts": self.attempts,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "total_duration": self.total_duration,
+            "load_duration": self.load_duration,
+            "prompt_duration": self.prompt_duration,
+            "eval_duration": self.eval_duration,
+            "tokens_per_second": self.tokens_per_second(),
+        }
+
+
+# Клиент держит пул соединений к Ollama, поэтому сегменты одного звонка не открывают
+# новое TCP-соединение на каждый запрос. На 5xx и ошибки соединения запрос повторяется
+# с экспоненциальной задержкой, таймаут чтения не повторяется, чтобы не нагружать модель дважды
+class OllamaClient:
+    def __init__(
+        self,
+        base_url: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 600.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        pool_size: int = 8,
+        verify: bool = True,
+        stream: bool = False,
+        keep_alive: str | None = "30m",
+        num_ctx: int | None = None,
+        structured: bool = True,
+        repair_retries: int = 2,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.verify = verify
+        self.stream = stream
+        # сколько Ollama держит модель (и кэш system-промпта) загруженной между запросами
+        self.keep_alive = keep_alive
+        # размер окна контекста должен совпадать с тем, под который режется диалог
+        self.num_ctx = num_ctx
+        self.structured = structured
+        self.repair_retries = repair_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def from_env(base_url: str) -> "OllamaClient":
+        return OllamaClient(
+            base_url,
+            connect_timeout=float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("OLLAMA_READ_TIMEOUT", "600")),
+            retries=int(os.getenv("OLLAMA_RETRIES", "3")),
+            verify=os.getenv("OLLAMA_VERIFY_TLS", "1") == "1",
+            stream=os.getenv("LLM_STREAM") == "1",
+            keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+            num_ctx=int(os.getenv("LLM_CONTEXT_WINDOW", "8192")),
+            structured=os.getenv("LLM_STRUCTURED", "1") == "1",
+            repair_retries=int(os.getenv("LLM_REPAIR_RETRIES", "2")),
+        )
+
+    def send(self, path: str, payload: dict, stream: bool = False) -> tuple[requests.Response, int]:
+        url = f"{self.base_url}/{path}"
+
+        for attempt in range(1, self.retries + 2):
+            try:
+                resp = self.session.post(url, json=payload, timeout=self.timeout, verify=self.verify, stream=stream)
+
+                if resp.status_code < 500:
+                    resp.raise_for_status()
+                    return resp, attempt
+
+                error = OllamaError(f"Ollama returned {resp.status_code}: {resp.text[:200]}")
+                resp.close()
+            except requests.ConnectionError as e:
+                error = OllamaError(f"Could not connect to Ollama: {e}")
+
+            if attempt > self.retries:
+                raise error
+
+            delay = self.backoff * 2 ** (attempt - 1)
+            logging.warning(f"{error}, retrying in {delay}s ({attempt}/{self.retries})")
+            time.sleep(delay)
+
+        raise OllamaError("unreachable")
+
+    def post(self, path: str, payload: dict) -> tuple[dict, int]:
+        resp, attempt = self.send(path, payload)
+        return resp.json(), attempt
+
+    def generate(self, prompt: Prompt | str, model: str | None, options: dict | None = None) -> dict:
+        started = time.perf_counter()
+
+        res, attempts = self.post(OLLAMA_GENERATE_PATH, build_payload(prompt, model, options, False, self.keep_alive, self.num_ctx, self.structured))
+
+        metrics = LlmMetrics(res, time.perf_counter() - started, attempts)
+        logging.debug(f"LLM METRICS: {metrics.to_dict()}")
+
+        res["metrics"] = metrics.to_dict()
+        return res
+
+    # Читает NDJSON-поток Ollama и скармливает его инкрементальному парсеру.
+    # Как только JSON-объект закрылся (или стало ясно, что он невалиден), соединение закрывается,
+    # и Ollama прекращает генерацию, не тратя время GPU на текст после JSON
+    def stream_generate(self, prompt: Prompt | str, model: str | None, options: dict | None = None, on_field=None) -> dict:
+        started = time.perf_counter()
+        parser = IncrementalJsonParser(on_field)
+        final = {}
+        chunks = 0
+
+        resp, attempts = self.send(OLLAMA_GENERATE_PATH, build_payload(prompt, model, options, True, self.keep_alive, self.num_ctx, self.structured), stream=True)
+
+        try:
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise OllamaError(f"Ollama error: {chunk['error']}")
+
+                chunks += 1
+                parser.feed(chunk.get("response", ""))
+
+                if chunk.get("done"):
+                    final = chunk
+                    break
+
+                if parser.done or parser.invalid:
+                    break
+        finally:
+            resp.close()
+
+        aborted = not final.get("done", False)
+        if aborted:
+            logging.debug(f"LLM stream aborted after {chunks} chunks: {'invalid JSON: ' + str(parser.error) if parser.invalid else 'JSON complete'}")
+
+        metrics = LlmMetrics(final or {"eval_count": chunks}, time.perf_counter() - started, attempts)
+        logging.debug(f"LLM METRICS: {metrics.to_dict()}")
+
+        return {
+            "response": parser.text() if parser.done else parser.buffer,
+            "done": parser.done,
+            "aborted": aborted,
+            "invalid": parser.invalid,
+            "fields": parser.fields,
+            "metrics": metrics.to_dict(),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+# Асинхронный клиент для параллельных запросов. Живет в пределах одного asyncio.run,
+# одновременно к Ollama уходит не больше concurrency запросов
+class AsyncOllamaClient:
+    def __init__(self, client: OllamaClient, concurrency: int = 4):
+        self.base_url = client.base_url
+        self.retries = client.retries
+        self.backoff = client.backoff
+        self.keep_alive = client.keep_alive
+        self.num_ctx = client.num_ctx
+        self.structured = client.structured
+        self.repair_retries = client.repair_retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        connect_timeout, read_timeout = client.timeout
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=concurrency),
+            verify=client.verify,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.http.aclose()
+
+    async def post(self, path: str, payload: dict) -> tuple[dict, int]:
+        url = f"{self.base_url}/{path}"
+
+        for attempt in range(1, self.retries + 2):
+            try:
+                async with self.semaphore:
+                    resp = await self.http.post(url, json=payload)
+
+                if resp.status_code < 500:
+                    resp.raise_for_status()
+                    return resp.json(), attempt
+
+                error = OllamaError(f"Ollama returned {resp.status_code}: {resp.text[:200]}")
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                error = OllamaError(f"Could not connect to Ollama: {e}")
+
+            if attempt > self.retries:
+                raise error
+
+            delay = self.backoff * 2 ** (attempt - 1)
+            logging.warning(f"{error}, retrying in {delay}s ({attempt}/{self.retries})")
+            await asyncio.sleep(delay)
+
+        raise OllamaError("unreachable")
+
+    async def generate(self, prompt: Prompt | str, model: str | None, options: dict | None = None) -> dict:
+        started = time.perf_counter()
+
+        res, attempts = await self.post(OLLAMA_GENERATE_PATH, build_payload(prompt, model, options, False, self.keep_alive, self.num_ctx, self.structured))
+
+        metrics = LlmMetrics(res, time.perf_counter() - started, attempts)
+        logging.debug(f"LLM METRICS: {metrics.to_dict()}")
+
+        res["metrics"] = metrics.to_dict()
+        return res
+
+
+clients: dict[str, OllamaClient] = {}
+clients_lock = threading.Lock()
+
+
+def get_client(ollama_server) -> OllamaClient:
+    if isinstance(ollama_server, OllamaClient):
+        return ollama_server
+
+    with clients_lock:
+        if ollama_server not in clients:
+            clients[ollama_server] = OllamaClient.from_env(ollama_server)
+
+        return clients[ollama_server]
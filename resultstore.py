@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+FINISHED = ("done", "failed")
+
+
+# Состояние и результаты задач в SQLite, так что они переживают перезапуск сервера.
+# Последние готовые результаты дополнительно держатся в памяти (LRU на hot_size записей) уже разобранными.
+# В базу пишут и другие процессы, поэтому запись из памяти отдается, только если строка в базе
+# все еще есть и не менялась: это поиск по первичному ключу без чтения и разбора самого результата.
+# Записи старше ttl удаляются, а при превышении max_bytes удаляются самые старые готовые результаты
+class ResultStore:
+    def __init__(self, path: str = "results.db", ttl: float = 7 * 24 * 3600, max_bytes: int = 1024**3, hot_size: int = 256, evict_every: float = 60.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hot_size = hot_size
+        self.evict_every = evict_every
+        self.hot: OrderedDict[str, tuple[str, object, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id TEXT PRIMARY KEY, state TEXT NOT NULL, data TEXT, size INTEGER NOT NULL DEFAULT 0, "
+            "created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_updated ON results (updated)")
+
+        self.total = 0
+        self.last_evict = 0.0
+        self.evict()
+
+    @staticmethod
+    def from_env():
+        return ResultStore(
+            os.getenv("RESULT_DB", "results.db"),
+            float(os.getenv("RESULT_TTL", str(7 * 24 * 3600))),
+            int(os.getenv("RESULT_MAX_BYTES", str(1024**3))),
+            int(os.getenv("RESULT_HOT_SIZE", "256")),
+        )
+
+    # новая задача; если воркер уже успел отметить ее как running, состояние не трогаем
+    def enqueue(self, task_id: str):
+        now = time.time()
+
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO results (id, state, created, updated) VALUES (?, 'queued', ?, ?) ON CONFLICT(id) DO NOTHING",
+                (task_id, now, now),
+            )
+
+    def set_state(self, task_id: str, state: str):
+        now = time.time()
+
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO results (id, state, created, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                (task_id, state, now, now),
+            )
+
+    def put(self, task_id: str, data, failed: bool = False):
+        state = "failed" if failed else "done"
+        encoded = json.dumps(data, ensure_ascii=False, default=str)
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute("SELECT size FROM results WHERE id = ?", (task_id,)).fetchone()
+            self.db.execute(
+                "INSERT INTO results (id, state, data, size, created, updated) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET state = excluded.state, data = excluded.data, size = excluded.size, updated = excluded.updated",
+                (task_id, state, encoded, len(encoded), now, now),
+            )
+            self.total += len(encoded) - (row[0] if row else 0)
+            self.remember(task_id, state, data, now)
+
+            if self.total > self.max_bytes or time.monotonic() - self.last_evict > self.evict_every:
+                self.evict_locked()
+
+    # (state, result) или None, если задача неизвестна или ее результат уже удален
+    def get(self, task_id: str) -> tuple[str, object] | None:
+        with self.lock:
+            hot = self.hot.get(task_id)
+            if hot is not None:
+                state, result, updated = hot
+                row = self.db.execute("SELECT updated FROM results WHERE id = ?", (task_id,)).fetchone()
+
+                if row is not None and row[0] == updated and time.time() - updated <= self.ttl:
+                    self.hot.move_to_end(task_id)
+                    return state, result
+
+                # результат устарел или его удалил или перезаписал другой процесс
+                del self.hot[task_id]
+
+            row = self.db.execute("SELECT state, data, updated FROM results WHERE id = ?", (task_id,)).fetchone()
+
+            if row is None:
+                return None
+
+            state, data, updated = row
+            if time.time() - updated > self.ttl:
+                return None
+
+            result = json.loads(data) if data is not None else None
+            if state in FINISHED:
+                self.remember(task_id, state, result, updated)
+
+            return state, result
+
+    def remember(self, task_id: str, state: str, data, updated: float):
+        self.hot[task_id] = (state, data, updated)
+        self.hot.move_to_end(task_id)
+
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    # Задачи, которые не успели завершиться до остановки сервера
+    def unfinished(self) -> list[tuple[str, str]]:
+        with self.lock:
+            return self.db.execute("SELECT id, state FROM results WHERE state NOT IN (?, ?)", FINISHED).fetchall()
+
+    def evict(self):
+        with self.lock:
+            self.evict_locked()
+
+    def evict_locked(self):
+        self.last_evict = time.monotonic()
+        # в эту же базу могут писать и другие процессы
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        expired = self.db.execute("DELETE FROM results WHERE updated < ? RETURNING id, size", (time.time() - self.ttl,)).fetchall()
+
+        removed = list(expired)
+        if self.total - sum(size for _, size in removed) > self.max_bytes:
+            excess = self.total - sum(size for _, size in removed) - int(self.max_bytes * 0.9)
+            for task_id, size in self.db.execute(
+                "SELECT id, size FROM results WHERE state IN (?, ?) ORDER BY updated", FINISHED
+            ).fetchall():
+                if excess <= 0:
+                    break
+                self.db.execute("DELETE FROM results WHERE id = ?", (task_id,))
+                removed.append((task_id, size))
+                excess -= size
+
+        for task_id, size in removed:
+            self.total -= size
+            self.hot.pop(task_id, None)
+
+        if removed:
+            logging.info(f"Result store evicted {len(removed)} results, {self.total} bytes left")
+
+    def stats(self) -> dict:
+        with self.lock:
+            counts = dict(self.db.execute("SELECT state, COUNT(*) FROM results GROUP BY state").fetchall())
+
+        return {"bytes": self.total, "hot": len(self.hot), "tasks": counts}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,18 +1,23 @@
-import json
+import contextlib
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import torch
 from dotenv import load_dotenv
 
 import llm
-from audio import Audio
+from audio import Audio, open_audio
+from cache import StageCache, package_version
 from diarization import Diarization
 from formatter import format_dialogue
-from regex_filter import FilteringString, RegexFilter
 from report import Report
-from transcriptor import Transcriptor, TranscriptorResult
-from voice import voices_to_dict
-from voicedb import VoiceDb
+from timings import StageTimings
+from tokens import TokenCounter
+from transcriptor import TranscriptionConfig, Transcriptor, TranscriptorResult
+from voice import VoiceEmbedder, voices_to_dict
+from voicedb import BatchedVoiceDb, VoiceDb
 
 
 def save_scam_voice(result, known, voices, vdb: VoiceDb):
@@ -37,6 +42,11 @@ def format_output(result, audio_dur):
     except KeyError:
         pass
 
+# progress(event, data) сообщает о завершении этапов: transcribed, diarized, voice_checked, llm_segment, llm_field
+def no_progress(event: str, data: dict):
+    pass
+
+
 def run(audio_env: str | None, audio_hardcoded: str | None):
     audio_path = None
 
@@ -47,76 +57,398 @@ def run(audio_env: str | None, audio_hardcoded: str | None):
     else:
         raise RuntimeError("Audio path is not provided")
 
-    audio = Audio(audio_path)
+    load_dotenv()
+
+    audio = open_audio(audio_path, streaming=os.getenv("STREAMING_AUDIO") == "1")
 
     output_results(audio)
 
 
 class AnalyzerEnvironment:
-    def __init__(self, diar_model: str, inter_model: str, voice_db: VoiceDb, hf_token: str):
+    def __init__(self, diar_model: str, inter_model: str, voice_db: VoiceDb | BatchedVoiceDb, hf_token: str, pipelined: bool = True):
         self.voice_db = voice_db
-        self.transcriptor = Transcriptor()
-        self.diarizator = Diarization(diar_model, hf_token)
+        self.cache = StageCache.from_env()
+        # выравнивание по словам требует от Whisper таймстемпов слов
+        self.word_alignment = os.getenv("WORD_ALIGNMENT") == "1"
+        self.transcription = TranscriptionConfig.from_env(word_timestamps=self.word_alignment)
+        self.diar_model = diar_model
         self.interference_model = inter_model
+        # ревизии моделей на Hugging Face входят в ключ кэша; "main" двигается вместе с репозиторием модели,
+        # поэтому для воспроизводимых результатов и корректного кэша нужен хэш коммита
+        self.diar_revision = os.getenv("DIARIZATION_REVISION", "main")
+        self.embedding_revision = os.getenv("EMBEDDING_REVISION", "main")
+        for name, revision in (("DIARIZATION_REVISION", self.diar_revision), ("EMBEDDING_REVISION", self.embedding_revision)):
+            if revision == "main":
+                logging.warning(f"{name} is not pinned, cached results may outlive model updates")
         self.hf_token = hf_token
-
-    def transcript(self, audio: Audio):
-        return self.transcriptor.transcribe(audio)
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+        self.max_turns_per_speaker = int(os.environ["EMBEDDING_MAX_TURNS"]) if os.getenv("EMBEDDING_MAX_TURNS") else None
+        # Модели загружаются при первом обращении, так что воркер полосы diarize не держит
+        # в памяти Whisper, а воркер transcript - pyannote и модель эмбеддингов
+        self.models: dict = {}
+        self.models_lock = threading.Lock()
+        self.pipelined = pipelined
+        self.llm_mode = os.getenv("LLM_MODE", "chained")
+        self.llm_concurrency = int(os.getenv("LLM_CONCURRENCY", "4"))
+        # ответ LLM кэшируется только по явному LLM_CACHE=1: ключ не видит, например, обновления модели под тем же именем
+        self.llm_cache = os.getenv("LLM_CACHE") == "1"
+        self.segmentation = llm.Segmentation(
+            context_window=int(os.getenv("LLM_CONTEXT_WINDOW", "8192")),
+            output_tokens=int(os.getenv("LLM_OUTPUT_TOKENS", "1024")),
+            overlap_tokens=int(os.getenv("LLM_SEGMENT_OVERLAP", "0")),
+            counter=TokenCounter(os.getenv("LLM_TOKENIZER")),
+        )
+        # отдельный поток под Whisper, чтобы транскрипция шла параллельно с диаризацией
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcript")
+
+    def model(self, name: str, load):
+        with self.models_lock:
+            if name not in self.models:
+                logging.info(f"Loading {name} model")
+                self.models[name] = load()
+
+            return self.models[name]
+
+    @property
+    def transcriptor(self) -> Transcriptor:
+        return self.model("transcription", lambda: Transcriptor(self.transcription))
+
+    @property
+    def diarizator(self) -> Diarization:
+        return self.model("diarization", lambda: Diarization(self.diar_model, self.hf_token, self.diar_revision))
+
+    @property
+    def embedder(self) -> VoiceEmbedder:
+        def load():
+            embedder = VoiceEmbedder(self.interference_model, self.hf_token, batch_size=self.embedding_batch_size, max_turns_per_speaker=self.max_turns_per_speaker, revision=self.embedding_revision)
+            embedder.warmup()
+            return embedder
+
+        return self.model("embedding", load)
+
+    # загружает все модели сразу, например перед форком воркеров, чтобы веса достались им через copy-on-write
+    def load(self):
+        self.transcriptor
+        self.diarizator
+        self.embedder
+
+    def cached(self, stage: str, config: dict, compute):
+        if self.cache is None:
+            return compute()
+
+        return self.cache.get_or_compute(stage, StageCache.key(stage, config), compute)
+
+    # при нарезке по диаризации границы кусков, а значит и текст, зависят от ее результата
+    def transcription_needs_diarization(self) -> bool:
+        return self.transcription.chunking == "diarization"
+
+    # Без нарезки по речи пакетный путь делит запись на окна по 30 с без подсказки текстом
+    # предыдущего окна, и текст получается не таким, как у whisper.transcribe, поэтому ключ у него свой.
+    # С нарезкой оба пути декодируют одни и те же куски одинаково
+    def transcription_config(self, audio: Audio, batched: bool = False) -> dict:
+        config = {
+            "audio": audio.content_hash(),
+            "source": type(audio).__name__,
+            **self.transcription.to_dict(),
+            "library": package_version(self.transcription.package()),
+            "torch": package_version("torch"),
+        }
+        if self.transcription_needs_diarization():
+            config["diarization"] = self.diarization_config(audio)
+        if batched and self.transcription.chunking == "off":
+            config["decode"] = "windows"
+
+        return config
+
+    def diarization_config(self, audio: Audio) -> dict:
+        return {
+            "audio": audio.content_hash(),
+            "model": self.diar_model,
+            "revision": self.diar_revision,
+            "library": package_version("pyannote.audio"),
+            "torch": package_version("torch"),
+        }
+
+    def transcript(self, audio: Audio, diarization = None):
+        if diarization is None and self.transcription_needs_diarization():
+            diarization = self.diarize(audio)
+
+        return self.cached("transcription", self.transcription_config(audio), lambda: self.transcriptor.transcribe(audio, diarization))
+
+    # Записи, которых нет в кэше, транскрибируются одним батчем, найденные в кэше берутся оттуда.
+    # Если батч упал, записи транскрибируются по одной, и ошибка одной записи не роняет остальные:
+    # на ее месте в результате будет исключение
+    def transcript_many(self, audios: list, diarizations: list | None = None) -> list:
+        diarizations = diarizations or [None] * len(audios)
+        results: list = [None] * len(audios)
+
+        if self.transcription_needs_diarization():
+            for i, audio in enumerate(audios):
+                if diarizations[i] is None:
+                    try:
+                        diarizations[i] = self.diarize(audio)
+                    except Exception as e:
+                        logging.exception(f"Diarization of {getattr(audio, 'path', 'audio')} failed")
+                        results[i] = e
+
+        missing = []
+        for i, audio in enumerate(audios):
+            if results[i] is not None:
+                continue
+
+            if self.cache is not None:
+                value, hit = self.cache.get("transcription", StageCache.key("transcription", self.transcription_config(audio, batched=True)))
+                if hit:
+                    logging.info("Cache hit: transcription")
+                    results[i] = value
+                    continue
+            missing.append(i)
+
+        if not missing:
+            return results
+
+        try:
+            fresh = self.transcriptor.transcribe_many([audios[i] for i in missing], [diarizations[i] for i in missing])
+        except Exception:
+            logging.exception(f"Batched transcription of {len(missing)} files failed, transcribing them one by one")
+            for i in missing:
+                try:
+                    results[i] = self.transcript(audios[i], diarizations[i])
+                except Exception as e:
+                    logging.exception(f"Transcription of {getattr(audios[i], 'path', 'audio')} failed")
+                    results[i] = e
+            return results
+
+        for i, result in zip(missing, fresh):
+            results[i] = result
+            if self.cache is not None:
+                self.cache.put("transcription", StageCache.key("transcription", self.transcription_config(audios[i], batched=True)), result)
+
+        return results
 
     def diarize(self, audio: Audio):
-        return self.diarizator.diarize(audio)
+        return self.cached("diarization", self.diarization_config(audio), lambda: self.diarizator.diarize(audio))
 
     def dialogue(self, audio: Audio | None = None, transcription: TranscriptorResult | None = None, diarization = None):
         if audio is None and (transcription is None or diarization is None):
             raise RuntimeError("Audio or both transcription and diarization is not provided")
 
-        if transcription is None:
-            transcription = self.transcript(audio) # type: ignore
-
         if diarization is None:
             diarization = self.diarize(audio) # type: ignore
 
-        return format_dialogue(diarization, transcription)
+        if transcription is None:
+            transcription = self.transcript(audio, diarization) # type: ignore
+
+        return format_dialogue(diarization, transcription, words=self.word_alignment)
 
     def voice_embeddings(self, audio: Audio, diarization = None):
         if diarization is None:
             diarization = self.diarize(audio) # type: ignore
 
-        return voices_to_dict(diarization, self.interference_model, self.hf_token, audio)
+        config = {
+            "diarization": self.diarization_config(audio),
+            "model": self.interference_model,
+            "revision": self.embedding_revision,
+            "max_turns_per_speaker": self.max_turns_per_speaker,
+        }
+
+        return self.cached("voice_embeddings", config, lambda: voices_to_dict(diarization, self.embedder, audio))
 
     def check_voice_database(self, voices):
         in_db = []
 
-        for sp, voice in voices.items():
-            if self.voice_db.find_voice(voice):
-                logging.info(f"{sp}'s voice found in the voicedb")
+        if not voices:
+            return in_db
+
+        speakers = list(voices.keys())
+        results = self.voice_db.search_many(torch.stack([voices[sp] for sp in speakers]))
+
+        for sp, matches in zip(speakers, results):
+            if matches:
+                logging.info(f"{sp}'s voice found in the voicedb: {matches}")
                 in_db.append(sp)
 
         return in_db
 
-    def analyze(self, dialogue, call_number, in_db, ollama_api, ollama_model):
-        return llm.analyze_with_llm(dialogue, call_number, in_db, ollama_api, ollama_model)
+    def analyze(self, dialogue, call_number, in_db, ollama_api, ollama_model, on_field=None, progress=no_progress):
+        if on_field is None:
+            def on_field(key, value):
+                logging.info(f"Partial LLM result for call {call_number}: {key} = {value}")
+                progress("llm_field", {"key": key, "value": value})
+
+        on_segment = lambda k, n: progress("llm_segment", {"segment": k, "segments": n})
+
+        compute = lambda: llm.analyze_with_llm(dialogue, call_number, in_db, ollama_api, ollama_model, mode=self.llm_mode, concurrency=self.llm_concurrency, on_field=on_field, on_segment=on_segment, segmentation=self.segmentation)
+
+        if self.llm_cache:
+            # ключ зависит от текста промптов, модели и параметров запроса, поэтому после их правки ответ пересчитывается
+            config = {
+                "dialogue": dialogue,
+                "known_scammers_voice": in_db,
+                "server": ollama_api,
+                "model": ollama_model,
+                "prompts": llm.prompt_fingerprint(),
+                "mode": self.llm_mode,
+                "segmentation": [self.segmentation.context_window, self.segmentation.output_tokens, self.segmentation.overlap_tokens],
+                "structured": os.getenv("LLM_STRUCTURED", "1") == "1",
+                "repair_retries": int(os.getenv("LLM_REPAIR_RETRIES", "2")),
+                "options": {"temperature": 0},
+            }
+            result = self.cached("llm", config, compute)
+        else:
+            result = compute()
+        result["call_number"] = call_number
+
+        return result
+
+    def analyze_from_zero(self, audio: Audio, call_number: int, ollama_api, ollama_model, progress=no_progress):
+        timings = StageTimings()
+
+        # хэш считается один раз до запуска этапов, которые потом параллельно ищут себя в кэше
+        if self.cache is not None:
+            with timings.measure("hashing"):
+                audio.content_hash()
+
+        if self.pipelined:
+            transcription, diarization, voice_embeddings, in_db = self.run_pipelined(audio, timings, progress)
+        else:
+            transcription, diarization, voice_embeddings, in_db = self.run_sequential(audio, timings, progress)
+
+        return self.complete_analysis(transcription, diarization, voice_embeddings, in_db, call_number, ollama_api, ollama_model, timings, progress)
+
+    # Несколько записей сразу: транскрипция идет одним батчем в фоне, пока для каждой записи
+    # по очереди считаются диаризация, эмбеддинги и поиск по базе. Ошибка одной записи
+    # не роняет остальные - на ее месте в результате будет исключение
+    def analyze_many(self, audios: list, call_numbers: list[int], ollama_api, ollama_model, progress: list | None = None) -> list:
+        timings = [StageTimings() for _ in audios]
+        progress = progress or [no_progress] * len(audios)
+        results: list = [None] * len(audios)
+
+        if self.cache is not None:
+            for audio, t in zip(audios, timings):
+                with t.measure("hashing"):
+                    audio.content_hash()
+
+        def timed_transcript_many(indices: list[int], diarizations=None) -> dict:
+            with contextlib.ExitStack() as stack:
+                for i in indices:
+                    stack.enter_context(timings[i].measure("transcription"))
+                transcriptions = dict(zip(indices, self.transcript_many([audios[i] for i in indices], diarizations)))
+
+            for i, transcription in transcriptions.items():
+                if not isinstance(transcription, Exception):
+                    progress[i]("transcribed", {"segments": len(transcription.segments)})
+
+            return transcriptions
+
+        diarizations: list = [None] * len(audios)
+        voices: list = [None] * len(audios)
+        in_dbs: list = [None] * len(audios)
+
+        if not self.transcription_needs_diarization():
+            transcription_future = self.executor.submit(timed_transcript_many, list(range(len(audios))))
+
+        for i, (audio, t) in enumerate(zip(audios, timings)):
+            try:
+                with t.measure("diarization"):
+                    diarizations[i] = self.diarize(audio)
+                progress[i]("diarized", {"speakers": len(diarizations[i].speaker_diarization.labels())})
+
+                with t.measure("voice_embeddings"):
+                    voices[i] = self.voice_embeddings(audio, diarization=diarizations[i])
+
+                with t.measure("voice_lookup"):
+                    in_dbs[i] = self.check_voice_database(voices[i])
+                progress[i]("voice_checked", {"known_speakers": in_dbs[i]})
+            except Exception as e:
+                logging.exception(f"Analysis of {getattr(audio, 'path', 'audio')} failed")
+                results[i] = e
+
+        if self.transcription_needs_diarization():
+            ok = [i for i, r in enumerate(results) if r is None]
+            transcriptions = timed_transcript_many(ok, [diarizations[i] for i in ok])
+        else:
+            transcriptions = transcription_future.result()
+
+        for i in range(len(audios)):
+            if results[i] is not None:
+                continue
+
+            if isinstance(transcriptions[i], Exception):
+                results[i] = transcriptions[i]
+                continue
+
+            try:
+                results[i] = self.complete_analysis(transcriptions[i], diarizations[i], voices[i], in_dbs[i], call_numbers[i], ollama_api, ollama_model, timings[i], progress[i])
+            except Exception as e:
+                logging.exception(f"Analysis of call {call_numbers[i]} failed")
+                results[i] = e
+
+        return results
+
+    def complete_analysis(self, transcription, diarization, voice_embeddings, in_db, call_number, ollama_api, ollama_model, timings: StageTimings, progress=no_progress):
+        with timings.measure("dialogue"):
+            dialogue = self.dialogue(transcription=transcription, diarization=diarization)
+
+        # ответ LLM уже разобран и проверен по схеме, неудачные запросы повторяются внутри llm
+        with timings.measure("llm"):
+            result = self.analyze(dialogue, call_number, in_db, ollama_api, ollama_model, progress=progress)
 
-    def analyze_from_zero(self, audio: Audio, call_number: int, ollama_api, ollama_model):
-        transcription = self.transcript(audio)
-        diarization = self.diarize(audio)
-        voice_embeddings = self.voice_embeddings(audio, diarization=diarization)
-        dialogue = self.dialogue(transcription=transcription, diarization=diarization)
-        in_db = self.check_voice_database(voice_embeddings)
+        self.save_scammers(result, voice_embeddings, in_db)
 
-        response = self.analyze(dialogue, call_number, in_db, ollama_api, ollama_model)
+        result["timings"] = timings.to_dict()
 
-        r = FilteringString(response['response']).filter(RegexFilter.md_json()) # type: ignore
+        return result
 
-        #logging.debug(r)
+    def run_sequential(self, audio: Audio, timings: StageTimings, progress=no_progress):
+        with timings.measure("diarization"):
+            diarization = self.diarize(audio)
+        progress("diarized", {"speakers": len(diarization.speaker_diarization.labels())})
 
-        result = json.loads(str(r))
-        #logging.debug(result)
+        with timings.measure("transcription"):
+            transcription = self.transcript(audio, diarization)
+        progress("transcribed", {"segments": len(transcription.segments)})
 
-        self.save_scammers(result, voice_embeddings, in_db)
+        with timings.measure("voice_embeddings"):
+            voice_embeddings = self.voice_embeddings(audio, diarization=diarization)
 
+        with timings.measure("voice_lookup"):
+            in_db = self.check_voice_database(voice_embeddings)
+        progress("voice_checked", {"known_speakers": in_db})
 
-        return result
+        return transcription, diarization, voice_embeddings, in_db
+
+    # Whisper не зависит от результата диаризации, поэтому запускаем его в фоне,
+    # а эмбеддинги и поиск по базе голосов делаем сразу после диаризации.
+    # При нарезке по репликам транскрипция стартует после диаризации, параллельно с эмбеддингами
+    def run_pipelined(self, audio: Audio, timings: StageTimings, progress=no_progress):
+        def timed_transcript(diarization=None):
+            with timings.measure("transcription"):
+                transcription = self.transcript(audio, diarization)
+            progress("transcribed", {"segments": len(transcription.segments)})
+
+            return transcription
+
+        if not self.transcription_needs_diarization():
+            transcription_future = self.executor.submit(timed_transcript)
+
+        with timings.measure("diarization"):
+            diarization = self.diarize(audio)
+        progress("diarized", {"speakers": len(diarization.speaker_diarization.labels())})
+
+        if self.transcription_needs_diarization():
+            transcription_future = self.executor.submit(timed_transcript, diarization)
+
+        with timings.measure("voice_embeddings"):
+            voice_embeddings = self.voice_embeddings(audio, diarization=diarization)
+
+        with timings.measure("voice_lookup"):
+            in_db = self.check_voice_database(voice_embeddings)
+        progress("voice_checked", {"known_speakers": in_db})
+
+        transcription = transcription_future.result()
+
+        return transcription, diarization, voice_embeddings, in_db
 
     def save_scammers(self, data, voices, skip):
         save_scam_voice(data, skip, voices, self.voice_db)
@@ -132,7 +464,7 @@ def run_with_file(audio: Audio):
     if tk is None:
         raise RuntimeError("Could not get HF_TOKEN from env vars")
 
-    vdb = VoiceDb()
+    vdb = VoiceDb(index=os.getenv("VOICE_INDEX", "matrix"))
 
     logging.info("Loading environment...")
     env = AnalyzerEnvironment(model, interference_model, vdb, tk)
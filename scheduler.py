@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+
+from taskqueue import QueuedTask, TaskQueue
+
+
+# Задачи полосы лежат в общей персистентной очереди (TaskQueue) под именем полосы.
+# decode превращает сохраненный payload обратно в задачу для обработчика
+class Lane:
+    def __init__(self, name: str, workers: int, tasks: TaskQueue, decode, batch_size: int = 1, batch_wait: float = 0.0, max_queue: int = 0, give_up=None):
+        self.name = name
+        self.workers = workers
+        self.tasks = tasks
+        self.decode = decode
+        self.give_up = give_up
+        # 0 - очередь не ограничена
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # выполняющиеся задачи: id и номер попытки, по которому продлевается и подтверждается аренда.
+        # Одна и та же задача может выполняться в процессе дважды, если ее аренда истекла и ее перехватил соседний поток
+        self.leases: set[tuple[str, int]] = set()
+
+    def put(self, task, priority: int = 0, key: str | None = None, reusable=None) -> tuple[str, bool]:
+        return self.tasks.put(self.name, task.id, task.to_dict(), priority, key, reusable)
+
+    def get(self):
+        return self.take(self.tasks.lease(self.name, give_up=self.give_up)[0])
+
+    # Первая задача ждется сколько угодно, остальные добираются из очереди,
+    # пока не наберется batch_size или не пройдет batch_wait
+    def get_batch(self) -> list:
+        leased = self.tasks.lease(self.name, self.batch_size, give_up=self.give_up)
+        deadline = time.monotonic() + self.batch_wait
+
+        while len(leased) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            leased.extend(self.tasks.lease(self.name, self.batch_size - len(leased), timeout, self.give_up))
+
+        return [self.take(item) for item in leased]
+
+    def take(self, item: QueuedTask):
+        wait = time.time() - item.enqueued
+
+        with self.lock:
+            self.leases.add((item.id, item.attempts))
+            self.in_flight += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        # номер попытки едет вместе с задачей, чтобы подтверждалась именно та аренда, под которой она выполнялась
+        task = self.decode(item.payload)
+        task.attempt = item.attempts
+
+        return task
+
+    # False, если аренду задачи уже перехватил другой воркер и она выполняется заново,
+    # или подтвердить ее не удалось: тогда задача вернется в очередь по истечении аренды
+    def done(self, task, ok: bool) -> bool:
+        with self.lock:
+            self.leases.discard((task.id, task.attempt))
+            self.in_flight -= 1
+            self.processed += 1
+            if not ok:
+                self.failed += 1
+
+        try:
+            return self.tasks.ack(task.id, task.attempt, ok)
+        except Exception:
+            logging.exception(f"Could not acknowledge task {task.id} in lane {self.name}")
+            return False
+
+    def active_leases(self) -> list[tuple[str, int]]:
+        with self.lock:
+            return list(self.leases)
+
+    def full(self) -> bool:
+        return self.max_queue > 0 and self.tasks.depth(self.name) >= self.max_queue
+
+    def oldest_wait(self) -> float:
+        return self.tasks.oldest_wait(self.name)
+
+    def stats(self) -> dict:
+        oldest_wait = self.oldest_wait()
+
+        with self.lock:
+            started = self.processed + self.in_flight
+
+            return {
+                "workers": self.workers,
+                "batch_size": self.batch_size,
+                "queue_depth": self.tasks.depth(self.name),
+                "in_flight": self.in_flight,
+                "processed": self.processed,
+                "failed": self.failed,
+                "avg_wait": self.total_wait / started if started else 0.0,
+                "max_wait": self.max_wait,
+                "oldest_wait": oldest_wait,
+            }
+
+
+# Каждая полоса (lane) обслуживается своими воркерами, поэтому короткие задачи
+# не ждут, пока закончится длинный анализ в соседней полосе
+# batch_handler получает список задач и возвращает список флагов успеха по каждой.
+# Задачи должны иметь id и to_dict(), decode восстанавливает задачу из to_dict().
+# release вызывается для задачи, только когда ее завершение подтверждено в очереди, и больше
+# она не выполнится; упавшая посреди обработки задача вернется в очередь со своими файлами.
+# give_up получает задачу из очереди (QueuedTask), которая исчерпала попытки и больше не выдается
+class Scheduler:
+    def __init__(self, env_factory, handler, tasks: TaskQueue, decode, batch_handler=None, release=None, give_up=None):
+        self.env_factory = env_factory
+        self.handler = handler
+        self.tasks = tasks
+        self.decode = decode
+        self.batch_handler = batch_handler
+        self.release = release
+        self.give_up = give_up
+        self.lanes: dict = {}
+        self.threads: list[threading.Thread] = []
+        self.heartbeat_lock = threading.Lock()
+        self.heartbeat_thread: threading.Thread | None = None
+
+    def add_lane(self, key, name: str, workers: int, batch_size: int = 1, batch_wait: float = 0.0, max_queue: int = 0):
+        if batch_size > 1 and self.batch_handler is None:
+            raise RuntimeError(f"Lane {name} is batched, but no batch handler is set")
+
+        self.lanes[key] = Lane(name, workers, self.tasks, self.decode, batch_size, batch_wait, max_queue, self.give_up)
+
+    def accepts(self, key) -> bool:
+        lane = self.lanes.get(key)
+        return lane is not None and lane.workers > 0
+
+    def full(self, key) -> bool:
+        return self.lanes[key].full()
+
+    # возвращает id задачи (для дубликата - id уже поставленной) и признак того, что задача новая;
+    # reusable(id) решает, можно ли вернуть уже завершенную задачу с тем же ключом
+    def submit(self, key, task, priority: int = 0, idempotency_key: str | None = None, reusable=None) -> tuple[str, bool]:
+        if not self.accepts(key):
+            raise RuntimeError(f"No workers for lane: {key}")
+
+        return self.lanes[key].put(task, priority, idempotency_key, reusable)
+
+    def start(self):
+        for lane in self.lanes.values():
+            for i in range(lane.workers):
+                t = threading.Thread(target=self.work, args=(lane,), name=f"{lane.name}-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    # цикл воркера полосы; в режиме процессов вызывается прямо в процессе воркера
+    def work(self, lane: Lane):
+        env = self.env_factory()
+        self.start_heartbeat()
+        logging.info(f"Worker {threading.current_thread().name} is ready")
+
+        while True:
+            if lane.batch_size > 1:
+                self._work_batch(env, lane)
+                continue
+
+            task = lane.get()
+
+            try:
+                self.handler(env, task)
+                ok = True
+            except Exception:
+                logging.exception(f"Task failed in lane {lane.name}")
+                ok = False
+
+            self.finish(lane, task, ok)
+
+    def finish(self, lane: Lane, task, ok: bool):
+        if not lane.done(task, ok):
+            logging.warning(f"Lease of task {task.id} in lane {lane.name} was lost, it is running again elsewhere")
+            return
+
+        if self.release is not None:
+            try:
+                self.release(task)
+            except Exception:
+                logging.exception(f"Could not release task {task.id}")
+
+    # Один поток на процесс продлевает аренду всех выполняющихся задач каждую треть срока аренды
+    def start_heartbeat(self):
+        with self.heartbeat_lock:
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(target=self.heartbeat, name="lease-heartbeat", daemon=True)
+                self.heartbeat_thread.start()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.tasks.lease_time / 3)
+
+            for lane in self.lanes.values():
+                leases = lane.active_leases()
+                if not leases:
+                    continue
+
+                try:
+                    lost = self.tasks.renew(leases)
+                except Exception:
+                    logging.exception(f"Could not renew leases in lane {lane.name}")
+                    continue
+
+                for task_id in lost:
+                    logging.warning(f"Lease of task {task_id} in lane {lane.name} expired before it was renewed")
+
+    def _work_batch(self, env, lane: Lane):
+        tasks = lane.get_batch()
+
+        try:
+            results = self.batch_handler(env, tasks) # type: ignore
+        except Exception:
+            logging.exception(f"Batch of {len(tasks)} tasks failed in lane {lane.name}")
+            results = [False] * len(tasks)
+
+        for task, ok in zip(tasks, results):
+            self.finish(lane, task, ok)
+
+    def stats(self) -> dict:
+        lanes = {lane.name: lane.stats() for lane in self.lanes.values()}
+
+        return {
+            "queue_depth": sum(s["queue_depth"] for s in lanes.values()),
+            "in_flight": sum(s["in_flight"] for s in lanes.values()),
+            "lanes": lanes,
+        }
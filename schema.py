@@ -0,0 +1,121 @@
+STRING_LIST = {"type": "array", "items": {"type": "string"}}
+RISK_SCORE = {"type": "number", "minimum": 0, "maximum": 10}
+CATEGORY = {"type": "string", "enum": ["normal", "suspicious", "fraudulent"]}
+
+REGULAR_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "call_number": {"type": "number"},
+        "category": CATEGORY,
+        "summary": {"type": "string"},
+        "risk_score": RISK_SCORE,
+        "indicators": STRING_LIST,
+        "scammers": STRING_LIST,
+        "suspiscious_segments": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "start": {"type": "number"},
+                    "end": {"type": "number"},
+                    "text": {"type": "string"},
+                    "reason": {"type": "string"},
+                },
+                "required": ["start", "end", "text", "reason"],
+            },
+        },
+    },
+    "required": ["call_number", "category", "summary", "risk_score", "indicators", "scammers", "suspiscious_segments"],
+}
+
+SEGMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": ["string", "null"]},
+        "segment_risk_score": RISK_SCORE,
+        "scammers": STRING_LIST,
+    },
+    "required": ["summary", "segment_risk_score", "scammers"],
+}
+
+FINAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "call_number": {"type": "number"},
+        "category": CATEGORY,
+        "summary": {"type": "string"},
+        "risk_score": RISK_SCORE,
+        "indicators": STRING_LIST,
+        "scammers": STRING_LIST,
+    },
+    "required": ["call_number", "category", "summary", "risk_score", "indicators", "scammers"],
+}
+
+
+TYPE_CHECKS = {
+    "string": lambda v: isinstance(v, str),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+    "array": lambda v: isinstance(v, list),
+    "object": lambda v: isinstance(v, dict),
+}
+
+
+# Схема один раз превращается в дерево замыканий, так что проверка ответа - это просто вызов функции
+# без повторного разбора схемы. Поддерживается только то подмножество JSON Schema, которое используется выше
+def compile_schema(schema: dict):
+    types = schema.get("type")
+    if isinstance(types, str):
+        types = [types]
+    type_checks = [TYPE_CHECKS[t] for t in types] if types else []
+
+    enum = schema.get("enum")
+    minimum = schema.get("minimum")
+    maximum = schema.get("maximum")
+    required = schema.get("required", [])
+    properties = {k: compile_schema(v) for k, v in schema.get("properties", {}).items()}
+    items = compile_schema(schema["items"]) if "items" in schema else None
+
+    def validate(value, path: str = "$") -> list[str]:
+        if type_checks and not any(check(value) for check in type_checks):
+            return [f"{path}: expected {' | '.join(types)}, got {type(value).__name__}"] # type: ignore
+
+        errors = []
+
+        if enum is not None and value not in enum:
+            errors.append(f"{path}: expected one of {enum}, got {value!r}")
+
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if minimum is not None and value < minimum:
+                errors.append(f"{path}: {value} is less than {minimum}")
+            if maximum is not None and value > maximum:
+                errors.append(f"{path}: {value} is greater than {maximum}")
+
+        if isinstance(value, dict):
+            for key in required:
+                if key not in value:
+                    errors.append(f"{path}: missing field {key}")
+            for key, check in properties.items():
+                if key in value:
+                    errors.extend(check(value[key], f"{path}.{key}"))
+
+        if isinstance(value, list) and items is not None:
+            for i, item in enumerate(value):
+                errors.extend(items(item, f"{path}[{i}]"))
+
+        return errors
+
+    return validate
+
+
+compiled = {}
+
+
+def validator_for(schema: dict):
+    key = id(schema)
+    if key not in compiled:
+        compiled[key] = compile_schema(schema)
+
+    return compiled[key]
@@ -1,25 +1,49 @@
+import asyncio
+import contextlib
 import logging
+import multiprocessing
 import os
-import queue
 import threading
 import uuid
 from enum import Enum
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, Form, UploadFile
+from fastapi import FastAPI, Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from audio import Audio
+from audio import open_audio
+from events import EventBus, WebhookError, format_sse
+from resultstore import FINISHED, ResultStore
 from run import AnalyzerEnvironment
-from voicedb import VoiceDb
+from scheduler import Scheduler
+from spool import Spool, SpoolError
+from taskqueue import QueuedTask, TaskQueue
+from workers import EventForwarder, SpoolForwarder, WorkerPool, forward_messages
+from voicedb import BatchedVoiceDb, VoiceDb
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-completed, completed_lock = {}, threading.Lock()
+events = EventBus()
 
-tasks = queue.Queue()
-app = FastAPI()
+voice_db: BatchedVoiceDb
+scheduler: Scheduler
+spool: Spool
+results: ResultStore
+task_queue: TaskQueue
+
+# шина событий живет в цикле событий сервера
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    events.bind(asyncio.get_running_loop())
+    try:
+        yield
+    finally:
+        await events.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 class TaskType(Enum):
     Analyze = 0
@@ -27,10 +51,20 @@ class TaskType(Enum):
     Diarize = 2
 
 class Task:
-    def __init__(self, path: str, id: str, type: TaskType):
+    def __init__(self, path: str, id: str, type: TaskType, hash: str | None = None, callback_url: str | None = None):
         self.path = path
         self.id = id
         self.type = type
+        # sha256 загруженного файла, посчитанный при приеме, чтобы кэш этапов не читал файл заново
+        self.hash = hash
+        self.callback_url = callback_url
+
+    def to_dict(self) -> dict:
+        return {"path": self.path, "id": self.id, "type": self.type.name, "hash": self.hash, "callback_url": self.callback_url}
+
+    @staticmethod
+    def from_dict(data: dict) -> "Task":
+        return Task(data["path"], data["id"], TaskType[data["type"]], data.get("hash"), data.get("callback_url"))
 
 
 def parse_task_type(type: str):
@@ -43,100 +77,384 @@ def parse_task_type(type: str):
             return TaskType.Diarize
 
 
-def work():
-    load_dotenv()
-
-    ollama_api = os.getenv("OLLAMA_API_URL")
-    ollama_model = os.getenv("OLLAMA_MODEL")
+def create_env():
     tk = os.getenv("HF_TOKEN")
 
     if tk is None:
         raise RuntimeError("HF_TOKEN not set")
 
-    env = AnalyzerEnvironment(
+    return AnalyzerEnvironment(
         "pyannote/speaker-diarization-community-1",
         "pyannote/embedding",
-        VoiceDb(),
+        voice_db,
         tk
     )
 
-    call_number = 1
 
-    while True:
-        task: Task = tasks.get()
+# в пуле процессов с fork модели всех этапов загружаются до форка и достаются воркерам через copy-on-write
+def create_shared_env():
+    env = create_env()
+    env.load()
 
-        audio = Audio(task.path)
+    return env
 
-        if task.type == TaskType.Analyze:
-            data = env.analyze_from_zero(audio, call_number, ollama_api, ollama_model)
-            call_number += 1
 
-        elif task.type == TaskType.Transcript:
-            data = {}
-            result = env.transcript(audio)
+# результат сохраняется до публикации done, так что подписчик, пришедший после done, найдет его в хранилище
+def finish(task: Task, data, failed: bool = False):
+    results.put(task.id, data, failed)
 
-            data["text"] = result.text
-            data["segments"] = []
+    events.publish(task.id, "done", {"result": data})
 
-            for seg in result.segments:
-                data["segments"].append({
-                    "start": seg["start"], # type: ignore
-                    "end": seg["end"], # type: ignore
-                    "text": seg["text"] # type: ignore
-                })
 
-        else:  # TaskType.Diarize
-            result = env.diarize(audio)
+def progress_for(task: Task):
+    return lambda event, data: events.publish(task.id, event, data)
 
-            diarization_result = []
-            for segment, _, speaker in result.speaker_diarization.itertracks(yield_label=True):
-                diarization_result.append({
-                    "start": segment.start,
-                    "end": segment.end,
-                    "speaker": speaker
-                })
 
-            data = diarization_result
+def process(env: AnalyzerEnvironment, task: Task):
+    results.set_state(task.id, "running")
 
-        with completed_lock:
-            completed[task.id] = data
+    try:
+        data = execute(env, task)
+    except Exception as e:
+        finish(task, {"error": str(e)}, failed=True)
+        raise
 
+    finish(task, data)
 
 
-@app.post("/schedule")
-async def analyze(file: UploadFile, type: str = Form(...)):
-    file_path = f"/tmp/{file.filename}"
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
+# загрузка удаляется, только когда планировщик подтвердил завершение задачи
+def release_upload(task: Task):
+    spool.release(task.path)
+
+
+# задача слишком много раз прерывалась вместе с воркером и больше не выполняется:
+# подписчики и webhook получают ошибку, загрузка удаляется
+def give_up(item: QueuedTask):
+    task = Task.from_dict(item.payload)
+    finish(task, {"error": "task was interrupted too many times"}, failed=True)
+    release_upload(task)
+
+
+# номера звонков идут из базы очереди и не повторяются между воркерами и перезапусками
+def next_call_number() -> int:
+    return task_queue.next_number("call")
+
+
+def load_audio(task: Task):
+    audio = open_audio(task.path, streaming=os.getenv("STREAMING_AUDIO") == "1")
+    audio.hash = task.hash
+
+    return audio
+
+
+def execute(env: AnalyzerEnvironment, task: Task):
+    audio = load_audio(task)
+
+    if task.type == TaskType.Analyze:
+        return env.analyze_from_zero(audio, next_call_number(), os.getenv("OLLAMA_API_URL"), os.getenv("OLLAMA_MODEL"), progress_for(task))
+
+    elif task.type == TaskType.Transcript:
+        result = env.transcript(audio)
+        events.publish(task.id, "transcribed", {"segments": len(result.segments)})
+
+        return transcript_to_dict(result)
+
+    else:  # TaskType.Diarize
+        result = env.diarize(audio)
+        events.publish(task.id, "diarized", {"speakers": len(result.speaker_diarization.labels())})
+
+        diarization_result = []
+        for segment, _, speaker in result.speaker_diarization.itertracks(yield_label=True):
+            diarization_result.append({
+                "start": segment.start,
+                "end": segment.end,
+                "speaker": speaker
+            })
+
+        return diarization_result
+
+
+def transcript_to_dict(result) -> dict:
+    data = {}
+
+    data["text"] = result.text
+    data["segments"] = []
+
+    for seg in result.segments:
+        data["segments"].append({
+            "start": seg["start"], # type: ignore
+            "end": seg["end"], # type: ignore
+            "text": seg["text"] # type: ignore
+        })
+
+    return data
+
+
+def process_batch(env: AnalyzerEnvironment, tasks: list[Task]) -> list[bool]:
+    for task in tasks:
+        results.set_state(task.id, "running")
+
+    try:
+        batch = execute_batch(env, tasks)
+    except Exception as e:
+        logging.exception(f"Batch of {len(tasks)} tasks failed")
+        batch = [e] * len(tasks)
+
+    ok = []
+    for task, result in zip(tasks, batch):
+        if isinstance(result, Exception):
+            finish(task, {"error": str(result)}, failed=True)
+            ok.append(False)
+        else:
+            finish(task, result)
+            ok.append(True)
+
+    return ok
+
+
+# Все задачи батча одного типа, потому что батч собирается из одной полосы
+def execute_batch(env: AnalyzerEnvironment, tasks: list[Task]) -> list:
+    outcomes: list = [None] * len(tasks)
+    indices, audios = [], []
+
+    for i, task in enumerate(tasks):
+        try:
+            audios.append(load_audio(task))
+            indices.append(i)
+        except Exception as e:
+            outcomes[i] = e
+
+    if not audios:
+        return outcomes
+
+    if tasks[0].type == TaskType.Analyze:
+        progress = [progress_for(tasks[i]) for i in indices]
+        batch = env.analyze_many(audios, [next_call_number() for _ in audios], os.getenv("OLLAMA_API_URL"), os.getenv("OLLAMA_MODEL"), progress)
+    else:
+        batch = []
+        for i, result in zip(indices, env.transcript_many(audios)):
+            if isinstance(result, Exception):
+                batch.append(result)
+                continue
+            events.publish(tasks[i].id, "transcribed", {"segments": len(result.segments)})
+            batch.append(transcript_to_dict(result))
 
-    task_type = parse_task_type(type)
+    for i, result in zip(indices, batch):
+        outcomes[i] = result
+
+    return outcomes
+
+
+def create_scheduler(env_factory=create_env):
+    s = Scheduler(env_factory, process, task_queue, Task.from_dict, process_batch, release_upload, give_up)
+    batch_wait = float(os.getenv("BATCH_MAX_WAIT", "0.1"))
+    max_queue = int(os.getenv("MAX_QUEUE_DEPTH", "0"))
+
+    s.add_lane(TaskType.Analyze, "analyze", int(os.getenv("ANALYZE_WORKERS", "1")), int(os.getenv("ANALYZE_BATCH_FILES", "1")), batch_wait, max_queue)
+    s.add_lane(TaskType.Transcript, "transcript", int(os.getenv("TRANSCRIPT_WORKERS", "1")), int(os.getenv("TRANSCRIPT_BATCH_FILES", "1")), batch_wait, max_queue)
+    s.add_lane(TaskType.Diarize, "diarize", int(os.getenv("DIARIZE_WORKERS", "1")), max_queue=max_queue)
+
+    return s
+
+
+# В процессе воркера хранилища открываются заново, а события и освобождение загрузок
+# уходят в API-процесс
+def init_worker(channel):
+    global voice_db, results, task_queue, events, spool
+
+    if "voice_db" not in globals():
+        voice_db = create_voice_db()
+
+    results = ResultStore.from_env()
+    task_queue = TaskQueue.from_env()
+    events = EventForwarder(channel) # type: ignore
+    spool = SpoolForwarder(channel) # type: ignore
+
+
+# запросы к базе голосов от всех воркеров объединяются в один проход по матрице
+def create_voice_db():
+    return BatchedVoiceDb(VoiceDb(index=os.getenv("VOICE_INDEX", "matrix")))
+
+
+# Заведомо неподходящие загрузки отклоняются по Content-Length еще до того, как тело будет прочитано
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    if request.url.path == "/schedule" and request.method == "POST":
+        try:
+            length = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"detail": "invalid Content-Length"})
+
+        if length > spool.max_file_bytes:
+            return JSONResponse(status_code=413, content={"detail": "upload is too large"})
+        if not spool.has_room(length):
+            return JSONResponse(status_code=503, content={"detail": "upload spool is full"})
+
+    return await call_next(request)
+
+
+# Разбирает и проверяет поля формы /schedule, до файла - только уже прочитанные
+def parse_schedule_form(fields: dict[str, str]):
+    task_type = parse_task_type(fields.get("type", ""))
 
     if task_type is None:
         raise HTTPException(status_code=400, detail="wrong task type")
 
-    task_id = uuid.uuid4()
-    tasks.put(Task(file_path, str(task_id), task_type))
+    callback_url = fields.get("callback_url") or None
+    try:
+        priority = int(fields.get("priority") or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="priority must be an integer")
+
+    if not scheduler.accepts(task_type):
+        raise HTTPException(status_code=503, detail="no workers for this task type")
+
+    if scheduler.full(task_type):
+        raise HTTPException(status_code=503, detail="task queue is full")
+
+    return task_type, callback_url, priority, fields.get("idempotency_key") or None
+
+
+# Форма: file, type, callback_url, priority, idempotency_key.
+# callback_url - необязательный webhook, на который POST'ом придет итоговый результат задачи.
+# Задачи с большим priority выполняются раньше. Повторная отправка с тем же idempotency_key
+# возвращает id уже поставленной задачи; без ключа каждая отправка - новая задача.
+# Тело не буферизуется: файл пишется в очередь загрузок по мере приема, а поля, пришедшие до файла,
+# проверяются до начала записи, так что неподходящая загрузка отклоняется, не дочитанной до конца
+@app.post("/schedule")
+async def analyze(request: Request):
+    def check_fields(fields: dict[str, str], filename: str | None):
+        if "type" in fields:
+            parse_schedule_form(fields)
+
+    try:
+        spooled, fields = await spool.receive(request.stream(), request.headers.get("content-type"), on_file=check_fields)
+    except SpoolError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail)
+
+    try:
+        task_type, callback_url, priority, idempotency_key = parse_schedule_form(fields)
+        if callback_url is not None:
+            await events.check_url(callback_url)
+    except WebhookError as e:
+        spool.release(spooled.path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        spool.release(spooled.path)
+        raise
+
+    task = Task(spooled.path, str(uuid.uuid4()), task_type, spooled.sha256, callback_url)
+    # завершенная задача переиспользуется, только пока ее результат еще хранится
+    task_id, created = scheduler.submit(task_type, task, priority, idempotency_key, lambda id: results.get(id) is not None)
+
+    if not created:
+        spool.release(spooled.path)
+        return {"task_id": task_id, "duplicate": True}
+
+    results.enqueue(task_id)
+    events.open(task_id, callback_url)
 
     return {"task_id": task_id}
 
 @app.get("/get_result")
 async def get_result(id: str):
-    ready, result = False, None
+    ready, result, state = False, None, None
 
-    try:
-        with completed_lock:
-            result = completed[id]
-            ready = True
-    except KeyError:
-        pass
+    record = results.get(id)
+    if record is not None:
+        state, result = record
+        ready = state in FINISHED
+
+    return { "ready": ready, "result": result, "state": state }
 
-    return { "ready": ready, "result": result }
+# Server-Sent Events: прогресс по этапам и итоговый результат (событие done) вместо опроса /get_result
+@app.get("/events")
+async def task_events(id: str):
+    queue = events.subscribe(id)
+
+    record = results.get(id)
+    result = record[1] if record is not None and record[0] in FINISHED else None
+
+    if result is None and not events.active(id):
+        events.unsubscribe(id, queue)
+        raise HTTPException(status_code=404, detail="unknown task")
+
+    async def stream():
+        try:
+            if result is not None:
+                yield format_sse({"event": "done", "data": {"result": result}})
+                return
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield format_sse(event)
+                if event["event"] == "done":
+                    return
+        finally:
+            events.unsubscribe(id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/stats")
+async def stats():
+    return {**scheduler.stats(), "spool_bytes": spool.used, "results": results.stats()}
 
 def main():
+    global voice_db, scheduler, spool, results, task_queue, events
+
     load_dotenv()
 
-    threading.Thread(target=work, daemon=True).start()
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    events = EventBus.from_env()
+
+    spool = Spool.from_env()
+    results = ResultStore.from_env()
+    task_queue = TaskQueue.from_env()
+    task_queue.prune(results.ttl)
+
+    # задачи, прерванные перезапуском, снова в очереди и снова принимают подписчиков
+    _, failed = task_queue.recover()
+    for item in failed:
+        give_up(item)
+
+    pending = task_queue.pending()
+    for item in pending:
+        results.set_state(item.id, "queued")
+        events.open(item.id, item.payload.get("callback_url"))
+
+    pending_ids = {item.id for item in pending}
+    for task_id, _ in results.unfinished():
+        if task_id not in pending_ids:
+            results.put(task_id, {"error": "task was lost"}, failed=True)
+
+    voice_db = create_voice_db()
+    scheduler = create_scheduler()
+
+    # WORKER_MODE=process: модели и обработка задач живут в отдельных процессах,
+    # этот процесс только принимает загрузки и раздает результаты
+    if os.getenv("WORKER_MODE", "thread") == "process":
+        control, pool_control = multiprocessing.Pipe(duplex=False)
+        start = os.getenv("WORKER_START", "spawn")
+        pool = WorkerPool(
+            create_shared_env if start == "fork" else create_env, create_scheduler, init_worker, pool_control, start, give_up,
+            int(os.getenv("WORKER_MAX_RESTARTS", "5")),
+        )
+        pool.start()
+        pool_control.close()
+        threading.Thread(target=forward_messages, args=(control, events, spool, results), name="worker-events", daemon=True).start()
+    else:
+        pool = None
+        scheduler.start()
+
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
+    finally:
+        if pool is not None:
+            pool.stop()
 
 if __name__ == "__main__":
     main()
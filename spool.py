@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import uuid
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+
+class SpoolError(RuntimeError):
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+class SpooledFile:
+    def __init__(self, path: str, size: int, sha256: str):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+
+# Загрузки пишутся на диск кусками по мере чтения из сокета, так что в памяти одновременно
+# лежит не больше одного куска тела запроса. Имя файла уникальное, хэш считается на лету.
+# Суммарный объем файлов, ждущих обработки, ограничен max_bytes
+class Spool:
+    def __init__(self, root: str = "/tmp/spool", max_file_bytes: int = 512 * 1024**2, max_bytes: int = 8 * 1024**3):
+        self.root = root
+        self.max_file_bytes = max_file_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+        self.used = sum(entry.stat().st_size for entry in os.scandir(self.root) if entry.is_file())
+
+    @staticmethod
+    def from_env():
+        return Spool(
+            os.getenv("SPOOL_DIR", "/tmp/spool"),
+            int(os.getenv("SPOOL_MAX_FILE_BYTES", str(512 * 1024**2))),
+            int(os.getenv("SPOOL_MAX_BYTES", str(8 * 1024**3))),
+        )
+
+    def has_room(self, size: int = 0) -> bool:
+        with self.lock:
+            return self.used + size <= self.max_bytes
+
+    def reserve(self, size: int):
+        with self.lock:
+            if self.used + size > self.max_bytes:
+                raise SpoolError(503, "upload spool is full")
+            self.used += size
+
+    def unreserve(self, size: int):
+        with self.lock:
+            self.used -= size
+
+    # Тело multipart/form-data разбирается по мере чтения из сокета: содержимое файла сразу пишется
+    # на диск, а текстовые поля собираются в словарь. Лимиты проверяются на каждом куске, поэтому
+    # слишком большая загрузка обрывается, не дочитанной до конца.
+    # stream - асинхронный итератор кусков тела, например request.stream().
+    # on_file(fields, filename) вызывается перед записью файла с уже прочитанными полями и может
+    # отклонить загрузку исключением, поэтому поля формы стоит отправлять до файла
+    async def receive(self, stream, content_type: str | None, file_field: str = "file", on_file=None) -> tuple[SpooledFile, dict[str, str]]:
+        receiver = UploadReceiver(self, content_type, file_field, on_file)
+
+        try:
+            async for chunk in stream:
+                await receiver.feed(chunk)
+            return await receiver.finish()
+        except BaseException:
+            receiver.discard()
+            raise
+
+    def release(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not remove spooled file {path}: {e}")
+            return
+
+        self.unreserve(size)
+
+
+# Состояние разбора одной загрузки. Парсер вызывает колбэки синхронно, поэтому события
+# копятся в списке и обрабатываются после каждого куска, а запись на диск идет в отдельном потоке
+class UploadReceiver:
+    def __init__(self, spool: Spool, content_type: str | None, file_field: str, on_file=None, max_field_bytes: int = 64 * 1024, max_parts: int = 16):
+        ctype, params = parse_options_header(content_type)
+        if ctype != b"multipart/form-data" or b"boundary" not in params:
+            raise SpoolError(400, "expected multipart/form-data")
+
+        self.spool = spool
+        self.file_field = file_field
+        self.on_file = on_file
+        self.max_field_bytes = max_field_bytes
+        self.max_parts = max_parts
+
+        self.events: list[tuple[str, bytes]] = []
+        self.parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": lambda: self.events.append(("begin", b"")),
+            "on_header_field": lambda data, start, end: self.events.append(("header_field", data[start:end])),
+            "on_header_value": lambda data, start, end: self.events.append(("header_value", data[start:end])),
+            "on_header_end": lambda: self.events.append(("header_end", b"")),
+            "on_headers_finished": lambda: self.events.append(("headers_finished", b"")),
+            "on_part_data": lambda data, start, end: self.events.append(("data", data[start:end])),
+            "on_part_end": lambda: self.events.append(("end", b"")),
+        })
+
+        self.fields: dict[str, str] = {}
+        self.parts = 0
+        self.header_field = b""
+        self.header_value = b""
+        self.disposition = b""
+        self.name = None
+        self.value = bytearray()
+        self.in_file = False
+
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    async def feed(self, chunk: bytes):
+        self.parser.write(chunk)
+        await self.handle()
+
+    async def finish(self) -> tuple[SpooledFile, dict[str, str]]:
+        self.parser.finalize()
+        await self.handle()
+
+        if self.file is None:
+            raise SpoolError(400, f"no {self.file_field} in upload")
+
+        await asyncio.to_thread(self.file.close)
+        return SpooledFile(self.path, self.size, self.hash.hexdigest()), self.fields # type: ignore
+
+    async def handle(self):
+        events, self.events = self.events, []
+        data = []
+
+        for kind, value in events:
+            match kind:
+                case "begin":
+                    self.parts += 1
+                    if self.parts > self.max_parts:
+                        raise SpoolError(400, "too many form fields")
+                    self.disposition = b""
+                    self.name = None
+                    self.value = bytearray()
+                case "header_field":
+                    self.header_field += value
+                case "header_value":
+                    self.header_value += value
+                case "header_end":
+                    if self.header_field.lower() == b"content-disposition":
+                        self.disposition = self.header_value
+                    self.header_field = b""
+                    self.header_value = b""
+                case "headers_finished":
+                    await self.start_part()
+                case "data" if self.in_file:
+                    data.append(value)
+                case "data":
+                    if len(self.value) + len(value) > self.max_field_bytes:
+                        raise SpoolError(413, f"form field {self.name} is too large")
+                    self.value += value
+                case "end" if self.in_file:
+                    self.in_file = False
+                case "end":
+                    if self.name is not None:
+                        self.fields[self.name] = self.value.decode("utf-8", errors="replace")
+
+        if data:
+            await self.write(b"".join(data))
+
+    async def start_part(self):
+        _, options = parse_options_header(self.disposition)
+        self.name = options[b"name"].decode("utf-8", errors="replace") if b"name" in options else None
+
+        if self.name != self.file_field:
+            return
+
+        if self.file is not None:
+            raise SpoolError(400, f"more than one {self.file_field} in upload")
+
+        filename = options[b"filename"].decode("utf-8", errors="replace") if b"filename" in options else None
+        if self.on_file is not None:
+            self.on_file(self.fields, filename)
+
+        suffix = os.path.splitext(filename or "")[1]
+        self.path = os.path.join(self.spool.root, f"{uuid.uuid4().hex}{suffix}")
+        self.file = open(self.path, "wb")
+        self.in_file = True
+
+    async def write(self, data: bytes):
+        if self.size + len(data) > self.spool.max_file_bytes:
+            raise SpoolError(413, f"upload is larger than {self.spool.max_file_bytes} bytes")
+
+        self.spool.reserve(len(data))
+        self.size += len(data)
+        self.hash.update(data)
+        await asyncio.to_thread(self.file.write, data) # type: ignore
+
+    def discard(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.spool.unreserve(self.size)
+        try:
+            os.remove(self.path) # type: ignore
+        except OSError:
+            pass
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class QueuedTask:
+    def __init__(self, id: str, payload: dict, enqueued: float, attempts: int):
+        self.id = id
+        self.payload = payload
+        self.enqueued = enqueued
+        self.attempts = attempts
+
+
+# Очередь задач в SQLite (WAL), которая переживает падение и перезапуск сервера.
+# Воркер берет задачу в аренду (lease), продлевает ее, пока задача выполняется, и подтверждает
+# после обработки. Задачи, чья аренда осталась незавершенной после падения, при старте возвращаются
+# в очередь, так что каждая задача выполняется хотя бы один раз. Задачи с большим priority выдаются раньше, при равном - по порядку постановки.
+# Ключ идемпотентности не дает поставить одну и ту же задачу дважды, пока она не завершилась ошибкой
+class TaskQueue:
+    def __init__(self, path: str = "tasks.db", lease: float = 3600.0, max_attempts: int = 3, poll_interval: float = 0.5):
+        self.path = path
+        self.lease_time = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id TEXT PRIMARY KEY, lane TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, payload TEXT NOT NULL, "
+            "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, enqueued REAL NOT NULL, "
+            "lease_until REAL, finished REAL, idempotency_key TEXT UNIQUE, owner INTEGER)"
+        )
+        # базы, созданные до появления владельца аренды
+        if "owner" not in [row[1] for row in self.db.execute("PRAGMA table_info(tasks)")]:
+            self.db.execute("ALTER TABLE tasks ADD COLUMN owner INTEGER")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_pending ON tasks (lane, state, priority DESC, enqueued)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @staticmethod
+    def from_env():
+        return TaskQueue(
+            os.getenv("TASK_DB", "tasks.db"),
+            float(os.getenv("TASK_LEASE", "3600")),
+            int(os.getenv("TASK_MAX_ATTEMPTS", "3")),
+        )
+
+    # Возвращает id задачи и признак того, что она новая. Для повторной постановки
+    # с тем же ключом возвращается id уже существующей задачи. Если задача с этим ключом провалилась
+    # или reusable(id) говорит, что ее результат уже удален, ключ в той же транзакции переходит к новой задаче
+    def put(self, lane: str, task_id: str, payload: dict, priority: int = 0, key: str | None = None, reusable=None) -> tuple[str, bool]:
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if key is not None:
+                    row = self.db.execute("SELECT id, state FROM tasks WHERE idempotency_key = ?", (key,)).fetchone()
+                    if row is not None and row[1] != "failed" and (row[1] != "done" or reusable is None or reusable(row[0])):
+                        self.db.execute("COMMIT")
+                        return row[0], False
+                    if row is not None:
+                        self.db.execute("UPDATE tasks SET idempotency_key = NULL WHERE id = ?", (row[0],))
+
+                self.db.execute(
+                    "INSERT INTO tasks (id, lane, priority, payload, state, enqueued, idempotency_key) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (task_id, lane, priority, json.dumps(payload), time.time(), key),
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        with self.cond:
+            self.cond.notify_all()
+
+        return task_id, True
+
+    # Задача с истекшей арендой выдается снова, но, как и в recover, не больше max_attempts раз:
+    # исчерпавшая попытки помечается как failed и передается в give_up, чтобы вызывающий мог ее завершить
+    def try_lease(self, lane: str, limit: int = 1, give_up=None) -> list[QueuedTask]:
+        now = time.time()
+
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                exhausted = self.db.execute(
+                    "SELECT id, payload, enqueued, attempts FROM tasks "
+                    "WHERE lane = ? AND state = 'leased' AND lease_until < ? AND attempts >= ?",
+                    (lane, now, self.max_attempts),
+                ).fetchall()
+                self.db.executemany(
+                    "UPDATE tasks SET state = 'failed', lease_until = NULL, finished = ? WHERE id = ?",
+                    [(now, row[0]) for row in exhausted],
+                )
+
+                rows = self.db.execute(
+                    "SELECT id, payload, enqueued, attempts FROM tasks "
+                    "WHERE lane = ? AND (state = 'queued' OR (state = 'leased' AND lease_until < ?)) "
+                    "ORDER BY priority DESC, enqueued LIMIT ?",
+                    (lane, now, limit),
+                ).fetchall()
+
+                self.db.executemany(
+                    "UPDATE tasks SET state = 'leased', lease_until = ?, attempts = attempts + 1, owner = ? WHERE id = ?",
+                    [(now + self.lease_time, os.getpid(), row[0]) for row in rows],
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        for id, payload, enqueued, attempts in exhausted:
+            logging.warning(f"Task {id} gave up after {attempts} attempts whose leases expired")
+            if give_up is not None:
+                try:
+                    give_up(QueuedTask(id, json.loads(payload), enqueued, attempts))
+                except Exception:
+                    logging.exception(f"Could not finish task {id}")
+
+        return [QueuedTask(id, json.loads(payload), enqueued, attempts + 1) for id, payload, enqueued, attempts in rows]
+
+    # Блокирует, пока не появится хотя бы одна задача. Постановку из этого же процесса
+    # будит условная переменная, задачи от других процессов подхватываются опросом
+    def lease(self, lane: str, limit: int = 1, timeout: float | None = None, give_up=None) -> list[QueuedTask]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            tasks = self.try_lease(lane, limit, give_up)
+            if tasks:
+                return tasks
+
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return []
+
+            with self.cond:
+                self.cond.wait(wait)
+
+    # Аренда определяется номером попытки: если аренда истекла и задачу взял другой воркер,
+    # подтверждение старой попытки ничего не меняет и возвращает False
+    def ack(self, task_id: str, attempt: int, ok: bool = True) -> bool:
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE tasks SET state = ?, lease_until = NULL, finished = ? WHERE id = ? AND state = 'leased' AND attempts = ?",
+                ("done" if ok else "failed", time.time(), task_id, attempt),
+            )
+
+        return cursor.rowcount == 1
+
+    # Продлевает аренду выполняющихся задач (пары id и номер попытки), чтобы долгая задача
+    # не досталась второму воркеру. Возвращает id задач, аренду которых уже перехватили
+    def renew(self, leases: list[tuple[str, int]]) -> list[str]:
+        lost = []
+
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for task_id, attempt in leases:
+                    cursor = self.db.execute(
+                        "UPDATE tasks SET lease_until = ? WHERE id = ? AND state = 'leased' AND attempts = ?",
+                        (time.time() + self.lease_time, task_id, attempt),
+                    )
+                    if cursor.rowcount == 0:
+                        lost.append(task_id)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        return lost
+
+    # Аренды, оставшиеся от упавшего процесса (owner - его pid, None - все аренды), возвращаются в очередь.
+    # Задача, которая уже max_attempts раз не дошла до конца, скорее всего сама роняет воркер и помечается как failed.
+    # Возвращает id возвращенных задач и сами проваленные задачи, чтобы вызывающий мог завершить их
+    def recover(self, owner: int | None = None) -> tuple[list[str], list[QueuedTask]]:
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                query = "SELECT id, payload, enqueued, attempts FROM tasks WHERE state = 'leased'"
+                if owner is None:
+                    rows = self.db.execute(query).fetchall()
+                else:
+                    rows = self.db.execute(query + " AND owner = ?", (owner,)).fetchall()
+                requeued = [id for id, _, _, attempts in rows if attempts < self.max_attempts]
+                failed = [QueuedTask(id, json.loads(payload), enqueued, attempts) for id, payload, enqueued, attempts in rows if attempts >= self.max_attempts]
+
+                self.db.executemany("UPDATE tasks SET state = 'queued', lease_until = NULL WHERE id = ?", [(id,) for id in requeued])
+                self.db.executemany("UPDATE tasks SET state = 'failed', lease_until = NULL, finished = ? WHERE id = ?", [(time.time(), task.id) for task in failed])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        if requeued or failed:
+            logging.info(f"Recovered {len(requeued)} interrupted tasks, {len(failed)} gave up after {self.max_attempts} attempts")
+
+        return requeued, failed
+
+    # Сквозной счетчик в базе очереди: номера не повторяются ни между процессами воркеров,
+    # ни после их перезапуска, ни после перезапуска сервера
+    def next_number(self, name: str) -> int:
+        with self.lock:
+            # fetchall доводит оператор до конца, иначе транзакция записи осталась бы открытой
+            return self.db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value",
+                (name,),
+            ).fetchall()[0][0]
+
+    def pending(self) -> list[QueuedTask]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, payload, enqueued, attempts FROM tasks WHERE state IN ('queued', 'leased') ORDER BY enqueued"
+            ).fetchall()
+
+        return [QueuedTask(id, json.loads(payload), enqueued, attempts) for id, payload, enqueued, attempts in rows]
+
+    def depth(self, lane: str) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM tasks WHERE lane = ? AND state = 'queued'", (lane,)).fetchone()[0]
+
+    def oldest_wait(self, lane: str) -> float:
+        with self.lock:
+            enqueued = self.db.execute("SELECT MIN(enqueued) FROM tasks WHERE lane = ? AND state = 'queued'", (lane,)).fetchone()[0]
+
+        return time.time() - enqueued if enqueued is not None else 0.0
+
+    # завершенные задачи хранятся, пока нужны для проверки идемпотентности
+    def prune(self, older_than: float):
+        with self.lock:
+            self.db.execute("DELETE FROM tasks WHERE state IN ('done', 'failed') AND finished < ?", (time.time() - older_than,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,60 @@
+import asyncio
+import socket
+
+import httpx
+import pytest
+
+from events import EventBus, WebhookError
+
+
+def answer(*ips):
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (ip, 443)) for ip in ips]
+
+
+class FakeResolver:
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def __call__(self, host, port, *args, **kwargs):
+        self.calls += 1
+        return self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+
+
+def deliver(bus: EventBus, url: str):
+    sent = []
+
+    def handler(request: httpx.Request):
+        sent.append(request)
+        return httpx.Response(200)
+
+    async def run():
+        bus.http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        await bus.deliver(url, "task", {"ok": True})
+        await bus.close()
+
+    asyncio.run(run())
+    return sent
+
+
+def test_webhook_connects_to_the_checked_address(monkeypatch):
+    # первое разрешение имени публичное, а следующее уже указывает на loopback
+    resolver = FakeResolver(answer("93.184.216.34"), answer("127.0.0.1"))
+    monkeypatch.setattr(socket, "getaddrinfo", resolver)
+
+    sent = deliver(EventBus(), "https://hooks.example.com/callback")
+
+    assert resolver.calls == 1
+    assert len(sent) == 1
+    assert sent[0].url.host == "93.184.216.34"
+    assert sent[0].headers["Host"] == "hooks.example.com"
+    assert sent[0].extensions["sni_hostname"] == "hooks.example.com"
+
+
+def test_webhook_rejects_host_with_any_internal_address(monkeypatch):
+    monkeypatch.setattr(socket, "getaddrinfo", FakeResolver(answer("93.184.216.34", "127.0.0.1")))
+
+    with pytest.raises(WebhookError):
+        asyncio.run(EventBus().check_url("https://hooks.example.com/callback"))
+
+    assert deliver(EventBus(), "https://hooks.example.com/callback") == []
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from llm_client import AsyncOllamaClient, OllamaClient, OllamaError, Prompt
+
+
+# Заглушка Ollama: отдает заранее заданные ответы по очереди и запоминает тела запросов.
+# Ответ - (status, body), body - словарь (обычный ответ) или список словарей (NDJSON-поток)
+class StubOllama:
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.requests: list[dict] = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                stub.requests.append({"path": self.path, "body": json.loads(self.rfile.read(length))})
+                status, body = stub.responses.pop(0)
+
+                if isinstance(body, list):
+                    data = b"".join(json.dumps(chunk).encode() + b"\n" for chunk in body)
+                    content_type = "application/x-ndjson"
+                else:
+                    data = json.dumps(body).encode()
+                    content_type = "application/json"
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def client(url: str, **kwargs) -> OllamaClient:
+    return OllamaClient(url, backoff=0, num_ctx=4096, **kwargs)
+
+
+def test_generate_retries_server_errors():
+    ok = {"response": "{}", "done": True, "eval_count": 3, "prompt_eval_count": 10}
+
+    with StubOllama([(503, {"error": "loading"}), (500, {"error": "oom"}), (200, ok)]) as stub:
+        res = client(stub.url, retries=2).generate(Prompt("instruction", "dialogue"), "model")
+
+    assert res["response"] == "{}"
+    assert res["metrics"]["attempts"] == 3
+    assert res["metrics"]["prompt_tokens"] == 10
+    assert len(stub.requests) == 3
+
+
+def test_generate_gives_up_after_retries():
+    with StubOllama([(503, {})] * 2) as stub:
+        with pytest.raises(OllamaError):
+            client(stub.url, retries=1).generate("prompt", "model")
+
+    assert len(stub.requests) == 2
+
+
+def test_client_errors_are_not_retried():
+    with StubOllama([(400, {"error": "bad request"})]) as stub:
+        with pytest.raises(requests.HTTPError):
+            client(stub.url, retries=3).generate("prompt", "model")
+
+    assert len(stub.requests) == 1
+
+
+def test_payload_carries_system_and_keep_alive():
+    schema = {"type": "object"}
+
+    with StubOllama([(200, {"response": "{}", "done": True})]) as stub:
+        client(stub.url, keep_alive="10m").generate(Prompt("instruction", "dialogue", schema), "model")
+
+    body = stub.requests[0]["body"]
+    assert stub.requests[0]["path"] == "/api/generate"
+    assert body["system"] == "instruction"
+    assert body["prompt"] == "dialogue"
+    assert body["keep_alive"] == "10m"
+    assert body["format"] == schema
+    assert body["options"]["num_ctx"] == 4096
+    assert body["stream"] is False
+
+
+def test_stream_generate_parses_ndjson():
+    chunks = [{"response": piece, "done": False} for piece in ['{"a": ', '1, "b"', ': "x"}']]
+    chunks.append({"response": "", "done": True, "eval_count": 3, "eval_duration": 10**9})
+    fields = []
+
+    with StubOllama([(200, chunks)]) as stub:
+        res = client(stub.url).stream_generate(Prompt("instruction", "dialogue"), "model", on_field=lambda key, value: fields.append(key))
+
+    assert stub.requests[0]["body"]["stream"] is True
+    assert res["done"]
+    assert not res["invalid"]
+    assert json.loads(res["response"]) == {"a": 1, "b": "x"}
+    assert fields == ["a", "b"]
+
+
+def test_stream_generate_rejects_missing_comma():
+    chunks = [{"response": '{"a": 1 "b": 2}', "done": False}, {"response": "", "done": True}]
+    fields = []
+
+    with StubOllama([(200, chunks)]) as stub:
+        res = client(stub.url).stream_generate("prompt", "model", on_field=lambda key, value: fields.append((key, value)))
+
+    assert res["invalid"]
+    assert not res["done"]
+    assert fields == []
+
+
+def test_stream_generate_reports_ollama_error():
+    with StubOllama([(200, [{"error": "model not found"}])]) as stub:
+        with pytest.raises(OllamaError):
+            client(stub.url).stream_generate("prompt", "model")
+
+
+def test_async_generate_retries_and_sends_system():
+    ok = {"response": "{}", "done": True}
+
+    async def run(url):
+        async with AsyncOllamaClient(client(url, retries=2, keep_alive="5m"), concurrency=2) as async_client:
+            return await async_client.generate(Prompt("instruction", "dialogue"), "model")
+
+    with StubOllama([(502, {}), (200, ok)]) as stub:
+        res = asyncio.run(run(stub.url))
+
+    assert res["metrics"]["attempts"] == 2
+    assert stub.requests[1]["body"]["system"] == "instruction"
+    assert stub.requests[1]["body"]["keep_alive"] == "5m"
@@ -0,0 +1,31 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.stages[stage] = {
+                    "start": start - self.started,
+                    "end": end - self.started,
+                    "duration": end - start,
+                }
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "total": time.perf_counter() - self.started,
+                "stages": dict(self.stages),
+            }
@@ -0,0 +1,40 @@
+import math
+import re
+
+WORD_RE = re.compile(r"[А-Яа-яЁё]+|[A-Za-z]+|\d+|\S")
+CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
+
+
+# Грубая оценка числа токенов без токенизатора. Кириллица токенизируется заметно мельче латиницы,
+# поэтому считаем по ~3 символа на токен для русских слов и ~4 для английских, с округлением вверх,
+# чтобы оценка была скорее завышенной, чем заниженной
+def approx_tokens(text: str) -> int:
+    count = 0
+
+    for word in WORD_RE.findall(text):
+        if CYRILLIC_RE.match(word):
+            count += math.ceil(len(word) / 3)
+        elif word.isalpha():
+            count += math.ceil(len(word) / 4)
+        elif word.isdigit():
+            count += math.ceil(len(word) / 3)
+        else:
+            count += 1
+
+    return count
+
+
+class TokenCounter:
+    def __init__(self, tokenizer: str | None = None):
+        self.tokenizer = None
+
+        if tokenizer:
+            from tokenizers import Tokenizer
+
+            self.tokenizer = Tokenizer.from_pretrained(tokenizer)
+
+    def count(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+        return approx_tokens(text)
@@ -1,22 +1,400 @@
+import logging
+import os
+import time
+
+import numpy as np
 import torch
 import whisper
+from whisper.tokenizer import get_tokenizer
 
-from audio import Audio
+from audio import Audio, StreamingAudio
+from chunking import energy_vad, pack_regions, regions_from_diarization
 
 
 class TranscriptorResult:
-    def __init__(self, data: dict[str, str | list]):
+    def __init__(self, data: dict[str, str | list], stats: dict | None = None):
         self.raw = data
         self.segments = data['segments']
         self.text = data['text']
+        self.stats = stats or {}
+
+
+class TranscriptionConfig:
+    def __init__(
+        self,
+        backend: str = "whisper",
+        model: str = "large",
+        precision: str = "fp32",
+        device: str | None = None,
+        beam_size: int | None = None,
+        best_of: int | None = None,
+        language: str | None = None,
+        word_timestamps: bool = False,
+        vad_filter: bool = False,
+        chunking: str = "off",
+        batch_size: int = 8,
+    ):
+        self.backend = backend
+        self.model = model
+        # fp32, fp16 (только GPU) или int8
+        self.precision = precision
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.beam_size = beam_size
+        self.best_of = best_of
+        # если язык задан, Whisper не тратит время на его определение
+        self.language = language
+        self.word_timestamps = word_timestamps
+        # отбрасывать тишину перед распознаванием (только faster-whisper)
+        self.vad_filter = vad_filter
+        # off - запись целиком, vad - участки речи по энергии, diarization - реплики из диаризации
+        self.chunking = chunking
+        # сколько 30-секундных кусков декодируется за один проход модели
+        self.batch_size = batch_size
+
+    # fp16 работает только на GPU, на CPU whisper.decode с ним падает
+    def fp16(self) -> bool:
+        return self.precision == "fp16" and str(self.device).startswith("cuda")
+
+    @staticmethod
+    def from_env(word_timestamps: bool = False) -> "TranscriptionConfig":
+        return TranscriptionConfig(
+            backend=os.getenv("TRANSCRIBE_BACKEND", "whisper"),
+            model=os.getenv("WHISPER_MODEL", "large"),
+            precision=os.getenv("WHISPER_PRECISION", "fp32"),
+            device=os.getenv("WHISPER_DEVICE"),
+            beam_size=int(os.environ["WHISPER_BEAM_SIZE"]) if os.getenv("WHISPER_BEAM_SIZE") else None,
+            best_of=int(os.environ["WHISPER_BEST_OF"]) if os.getenv("WHISPER_BEST_OF") else None,
+            language=os.getenv("WHISPER_LANGUAGE") or None,
+            word_timestamps=word_timestamps,
+            vad_filter=os.getenv("WHISPER_VAD") == "1",
+            chunking=os.getenv("TRANSCRIBE_CHUNKING", "off"),
+            batch_size=int(os.getenv("TRANSCRIBE_BATCH_SIZE", "8")),
+        )
+
+    # backend:model[:precision[:beam_size]], например faster-whisper:medium:int8:1
+    @staticmethod
+    def parse(spec: str, language: str | None = None) -> "TranscriptionConfig":
+        parts = spec.split(":")
+        return TranscriptionConfig(
+            backend=parts[0],
+            model=parts[1] if len(parts) > 1 else "large",
+            precision=parts[2] if len(parts) > 2 else "fp32",
+            beam_size=int(parts[3]) if len(parts) > 3 else None,
+            language=language,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "backend": self.backend,
+            "model": self.model,
+            "precision": self.precision,
+            "device": self.device,
+            "beam_size": self.beam_size,
+            "best_of": self.best_of,
+            "language": self.language,
+            "word_timestamps": self.word_timestamps,
+            "vad_filter": self.vad_filter,
+            "chunking": self.chunking,
+        }
+
+    # пакет, чья версия входит в ключ кэша транскрипции
+    def package(self) -> str:
+        return "openai-whisper" if self.backend == "whisper" else self.backend
+
+    def __str__(self):
+        return f"{self.backend}:{self.model}:{self.precision}:{self.beam_size or '-'}@{self.device}"
+
+
+class WhisperBackend:
+    # пороги, по которым whisper.transcribe повторяет декодирование с большей температурой
+    COMPRESSION_RATIO_THRESHOLD = 2.4
+    LOGPROB_THRESHOLD = -1.0
+    NO_SPEECH_THRESHOLD = 0.6
+
+    def __init__(self, config: TranscriptionConfig):
+        self.config = config
+        self.model = whisper.load_model(config.model, device=config.device)
+
+        if config.precision == "int8":
+            if config.device != "cpu":
+                raise RuntimeError("int8 whisper is only supported on CPU, use faster-whisper for GPU")
+            self.model = quantize_whisper(self.model)
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        c = self.config
+        options = {
+            "fp16": c.fp16(),
+            "word_timestamps": c.word_timestamps,
+            "language": c.language,
+        }
+        if c.beam_size is not None:
+            options["beam_size"] = c.beam_size
+        if c.best_of is not None:
+            options["best_of"] = c.best_of
+
+        return self.model.transcribe(audio, **options)
+
+    # Куски по 30 с декодируются одним батчем: одна спектрограмма на кусок, один вызов decode на всех.
+    # best_of не передается - он допустим только при сэмплировании с ненулевой температурой.
+    # Батч декодируется с нулевой температурой, а кусок, который whisper.transcribe стал бы
+    # повторять с большей температурой (зацикливание или низкая уверенность), уходит в transcribe
+    # по одному и проходит ту же цепочку повторов. Тишина отбрасывается так же, как в transcribe
+    def decode_batch(self, chunks: list[np.ndarray]) -> list[dict]:
+        c = self.config
+        n_mels = self.model.dims.n_mels
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(chunk)), n_mels)
+            for chunk in chunks
+        ]).to(c.device)
+
+        options = whisper.DecodingOptions(
+            language=c.language,
+            beam_size=c.beam_size,
+            fp16=c.fp16(),
+            without_timestamps=False,
+        )
+
+        results = []
+        for chunk, result in zip(chunks, whisper.decode(self.model, mel, options)):
+            if result.no_speech_prob > self.NO_SPEECH_THRESHOLD and result.avg_logprob < self.LOGPROB_THRESHOLD:
+                results.append({"text": "", "segments": [], "language": result.language})
+                continue
+
+            if result.compression_ratio > self.COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < self.LOGPROB_THRESHOLD:
+                logging.debug(f"Chunk needs temperature fallback (compression {result.compression_ratio:.2f}, logprob {result.avg_logprob:.2f})")
+                results.append(self.transcribe(chunk))
+                continue
+
+            tokenizer = get_tokenizer(self.model.is_multilingual, num_languages=self.model.num_languages, language=result.language, task="transcribe")
+            segments = tokens_to_segments(result.tokens, tokenizer, len(chunk) / whisper.audio.SAMPLE_RATE)
+            results.append({"text": "".join(seg["text"] for seg in segments), "segments": segments, "language": result.language})
+
+        return results
+
+
+# quantize_dynamic сравнивает типы модулей точно, а слои openai-whisper - это подкласс nn.Linear,
+# который только приводит веса к типу входа. На CPU в fp32 он ничем не отличается от nn.Linear,
+# поэтому слоям возвращается базовый класс, и только после этого они квантуются
+def quantize_whisper(model):
+    for module in model.modules():
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = torch.nn.Linear
+
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    quantized = sum(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules())
+    if quantized == 0:
+        raise RuntimeError("int8 quantization did not convert any whisper layers")
+    logging.info(f"Quantized {quantized} whisper linear layers to int8")
+
+    return model
+
+
+# Таймстемп-токены Whisper идут парами вокруг текста сегмента: <|0.00|> текст <|2.40|>, шаг 20 мс
+def tokens_to_segments(tokens: list[int], tokenizer, duration: float) -> list[dict]:
+    segments = []
+    start = None
+    text_tokens = []
+
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            t = (token - tokenizer.timestamp_begin) * 0.02
+            if start is not None and text_tokens:
+                segments.append({"id": len(segments), "start": start, "end": t, "text": tokenizer.decode(text_tokens)})
+                start = None
+                text_tokens = []
+            else:
+                start = t
+        elif token < tokenizer.eot:
+            if start is None:
+                start = segments[-1]["end"] if segments else 0.0
+            text_tokens.append(token)
+
+    # модель оборвала последний сегмент без закрывающего таймстемпа
+    if text_tokens:
+        segments.append({"id": len(segments), "start": start, "end": duration, "text": tokenizer.decode(text_tokens)})
+
+    return segments
+
+
+# faster-whisper (CTranslate2) с тем же форматом результата, что и у openai-whisper
+class FasterWhisperBackend:
+    COMPUTE_TYPES = {"fp32": "float32", "fp16": "float16", "int8": "int8"}
+
+    def __init__(self, config: TranscriptionConfig):
+        from faster_whisper import WhisperModel
+
+        self.config = config
+        self.model = WhisperModel(config.model, device=config.device, compute_type=self.COMPUTE_TYPES[config.precision])
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        c = self.config
+        segments, info = self.model.transcribe(
+            audio,
+            beam_size=c.beam_size or 5,
+            best_of=c.best_of or 5,
+            language=c.language,
+            word_timestamps=c.word_timestamps,
+            vad_filter=c.vad_filter,
+        )
+
+        result_segments = []
+        for seg in segments:
+            data = {"id": len(result_segments), "start": seg.start, "end": seg.end, "text": seg.text}
+            if seg.words is not None:
+                data["words"] = [{"start": w.start, "end": w.end, "word": w.word, "probability": w.probability} for w in seg.words]
+            result_segments.append(data)
+
+        return {
+            "text": "".join(seg["text"] for seg in result_segments),
+            "segments": result_segments,
+            "language": info.language,
+        }
+
+
+def create_backend(config: TranscriptionConfig):
+    match config.backend:
+        case "whisper":
+            return WhisperBackend(config)
+        case "faster-whisper":
+            return FasterWhisperBackend(config)
+
+    raise RuntimeError(f"Unknown transcription backend: {config.backend}")
+
 
 class Transcriptor:
-    def __init__(self):
-        self.model = whisper.load_model("large")
+    def __init__(self, config: TranscriptionConfig | None = None):
+        self.config = config or TranscriptionConfig()
+        self.backend = create_backend(self.config)
+
+    def speech_regions(self, audio: Audio | StreamingAudio, diarization=None) -> list[tuple[float, float]] | None:
+        match self.config.chunking:
+            case "off":
+                return None
+            case "vad":
+                return energy_vad(audio)
+            case "diarization":
+                if diarization is None:
+                    return energy_vad(audio)
+                return regions_from_diarization(diarization)
+
+        raise RuntimeError(f"Unknown transcription chunking: {self.config.chunking}")
+
+    def transcribe(self, audio: Audio | StreamingAudio, diarization=None) -> TranscriptorResult:
+        started = time.perf_counter()
+        regions = self.speech_regions(audio, diarization)
+
+        if regions is not None:
+            data = self.transcribe_regions(audio, regions)
+        elif isinstance(audio, StreamingAudio):
+            data = self.transcribe_stream(audio)
+        else:
+            data = self.backend.transcribe(audio.numpy())
+
+        return TranscriptorResult(data, self.stats(audio, time.perf_counter() - started, regions))
+
+    # real-time factor: сколько секунд обработки уходит на секунду аудио
+    def stats(self, audio: Audio | StreamingAudio, elapsed: float, regions: list[tuple[float, float]] | None, batch: int = 1) -> dict:
+        duration = audio.get_audio_duration()
+        stats = {
+            "config": str(self.config),
+            "audio_duration": duration,
+            "elapsed": elapsed,
+            "rtf": elapsed / duration if duration else 0.0,
+        }
+        if regions is not None:
+            stats["speech_duration"] = sum(end - start for start, end in regions)
+        if batch > 1:
+            stats["batch"] = batch
+        logging.info(f"Transcription {stats['config']}: {duration:.1f}s of audio in {elapsed:.1f}s, RTF {stats['rtf']:.3f}")
+
+        return stats
+
+    # Куски нескольких записей декодируются общими батчами, так что под нагрузкой модель
+    # получает полный батч, а не по одному файлу за вызов. Без нарезки по речи запись
+    # делится на окна по 30 с. RTF считается по общему времени батча и суммарной длительности
+    def transcribe_many(self, audios: list, diarizations: list | None = None) -> list[TranscriptorResult]:
+        started = time.perf_counter()
+        diarizations = diarizations or [None] * len(audios)
+
+        regions = []
+        for audio, diarization in zip(audios, diarizations):
+            speech = self.speech_regions(audio, diarization)
+            regions.append(speech if speech is not None else [(0.0, audio.get_audio_duration())])
+
+        data = self.decode_regions(audios, regions)
+
+        elapsed = time.perf_counter() - started
+        total = sum(audio.get_audio_duration() for audio in audios)
+
+        results = []
+        for audio, file_regions, file_data in zip(audios, regions, data):
+            share = elapsed * audio.get_audio_duration() / total if total else 0.0
+            speech = file_regions if self.config.chunking != "off" else None
+            results.append(TranscriptorResult(file_data, self.stats(audio, share, speech, batch=len(audios))))
+
+        return results
+
+    # каждое окно транскрибируется отдельно, таймстемпы сдвигаются на начало окна
+    def transcribe_stream(self, audio: StreamingAudio) -> dict:
+        text = []
+        segments = []
+        language = None
+
+        for offset, chunk in audio.chunks():
+            result = self.backend.transcribe(chunk[0].numpy())
+            language = language or result.get("language")
+            text.append(result["text"])
+
+            for seg in result["segments"]:
+                seg["id"] = len(segments)
+                seg["start"] += offset
+                seg["end"] += offset
+                for word in seg.get("words", []):
+                    word["start"] += offset
+                    word["end"] += offset
+                segments.append(seg)
+
+        return {"text": "".join(text), "segments": segments, "language": language}
+
+    # Распознаются только участки речи, склеенные в куски до 30 с, а таймстемпы
+    # переводятся обратно на шкалу исходной записи
+    def transcribe_regions(self, audio: Audio | StreamingAudio, regions: list[tuple[float, float]]) -> dict:
+        return self.decode_regions([audio], [regions])[0]
+
+    def decode_regions(self, audios: list, regions: list[list[tuple[float, float]]]) -> list[dict]:
+        jobs = [(i, chunk) for i, file_regions in enumerate(regions) for chunk in pack_regions(file_regions)]
+        data = [{"text": "", "segments": [], "language": None} for _ in audios]
+
+        for b in range(0, len(jobs), self.config.batch_size):
+            batch = jobs[b:b + self.config.batch_size]
+            results = self.decode_batch([chunk.samples(audios[i]) for i, chunk in batch])
+
+            for (i, chunk), result in zip(batch, results):
+                segments = data[i]["segments"]
+                data[i]["language"] = data[i]["language"] or result.get("language")
+
+                for seg in result["segments"]:
+                    seg["id"] = len(segments)
+                    seg["start"] = chunk.to_original(seg["start"])
+                    seg["end"] = chunk.to_original(seg["end"], end=True)
+                    for word in seg.get("words", []):
+                        word["start"] = chunk.to_original(word["start"])
+                        word["end"] = chunk.to_original(word["end"], end=True)
+                    segments.append(seg)
+
+        for file_data in data:
+            file_data["text"] = "".join(seg["text"] for seg in file_data["segments"])
+
+        return data
+
+    # батчевое декодирование не дает таймстемпов слов, в этом случае и для faster-whisper куски идут по одному
+    def decode_batch(self, chunks: list) -> list[dict]:
+        if hasattr(self.backend, "decode_batch") and not self.config.word_timestamps:
+            return self.backend.decode_batch(chunks)
 
-    def transcribe(self, audio: Audio) -> TranscriptorResult:
-        return TranscriptorResult(self.model.transcribe(audio.numpy(), fp16=False))
+        return [self.backend.transcribe(chunk) for chunk in chunks]
 
     def cleanup(self):
-        del self.model
+        del self.backend
         torch.cuda.empty_cache()
@@ -1,42 +1,129 @@
 import torch
-import torchaudio
 from pyannote.audio import Inference, Model
-from pyannote.core import SlidingWindowFeature
 
+from audio import resample
 
-def voices_to_dict(diarization, model: str, tk: str, audio):
-    m = Model.from_pretrained(model, token=tk)
-    if m is None:
-        raise RuntimeError(f"Could not initialized model: {model}")
 
-    embedding_model = Inference(m)
+class VoiceEmbedder:
+    def __init__(self, model: str, tk: str, batch_size: int = 32, max_turns_per_speaker: int | None = None, revision: str = "main"):
+        m = Model.from_pretrained(model, token=tk, revision=revision)
+        if m is None:
+            raise RuntimeError(f"Could not initialized model: {model}")
 
-    speaker_embeddings = {}
-    sr = 16000
+        self.model = m
+        self.model.eval()
+        self.inference = Inference(m)
+        self.sr = 16000
+        self.batch_size = batch_size
+        self.max_turns_per_speaker = max_turns_per_speaker
 
-    waveform = torchaudio.functional.resample(audio.waveform, audio.sr, sr)
+        # окна те же, что и у скользящего Inference, чтобы эмбеддинги совпадали с теми, что уже лежат в базе
+        self.window = int(self.inference.duration * self.sr)
+        self.step = int(self.inference.step * self.sr)
 
-    for turn, speaker in diarization.speaker_diarization:
-        start_sample = int(turn.start * sr)
-        end_sample   = int(turn.end   * sr)
-        turn_waveform = waveform[:, start_sample:end_sample]
+    # первый прогон модели заметно дольше остальных, поэтому делаем его при загрузке, а не на первом звонке
+    def warmup(self):
+        self.infer(torch.zeros(self.batch_size, 1, self.window))
 
-        if turn_waveform.shape[1] < sr * 0.2:
-            continue
+    def infer(self, batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.model(batch.to(self.model.device)).cpu()
 
-        emb = embedding_model({"waveform": turn_waveform, "sample_rate": sr})
+    def pad(self, waveform: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.pad(waveform, (0, self.window - waveform.shape[1]))
 
-        if isinstance(emb, SlidingWindowFeature):
-            emb_tensor = torch.from_numpy(emb.data)
-            emb_tensor = emb_tensor.mean(dim=0)
-        else:
-            emb_tensor = emb
+    def crops(self, waveform: torch.Tensor):
+        num_samples = waveform.shape[1]
 
-        if speaker not in speaker_embeddings:
-            speaker_embeddings[speaker] = []
-        speaker_embeddings[speaker].append(emb_tensor)
+        if num_samples < self.window:
+            yield self.pad(waveform)
+            return
 
-    for speaker in speaker_embeddings:
-        speaker_embeddings[speaker] = torch.stack(speaker_embeddings[speaker]).mean(dim=0)
+        num_chunks = 1 + (num_samples - self.window) // self.step
+        for i in range(num_chunks):
+            start = i * self.step
+            yield waveform[:, start:start + self.window]
 
-    return speaker_embeddings
+        if (num_samples - self.window) % self.step > 0:
+            yield self.pad(waveform[:, num_chunks * self.step:])
+
+    def select_turns(self, diarization):
+        by_speaker = {}
+
+        for turn, speaker in diarization.speaker_diarization:
+            if turn.end - turn.start < 0.2:
+                continue
+
+            by_speaker.setdefault(speaker, []).append((turn.start, turn.end))
+
+        if self.max_turns_per_speaker is not None:
+            for speaker, turns in by_speaker.items():
+                turns.sort(key=lambda t: t[1] - t[0], reverse=True)
+                by_speaker[speaker] = turns[:self.max_turns_per_speaker]
+
+        return [(speaker, start, end) for speaker, turns in by_speaker.items() for start, end in turns]
+
+    def crop(self, audio, start: float, end: float) -> torch.Tensor:
+        return resample(audio.crop(start, end), audio.sr, self.sr)
+
+    # все окна всех реплик прогоняются через модель пачками по batch_size,
+    # потом усредняются сначала по реплике, затем по спикеру.
+    # Реплики вырезаются из аудио по мере надобности, поэтому в памяти одновременно лежит не больше одной пачки
+    def embed(self, diarization, audio):
+        turns = self.select_turns(diarization)
+
+        if not turns:
+            return {}
+
+        turn_sums = None
+        turn_counts = torch.zeros(len(turns))
+        batch, owners = [], []
+
+        def flush():
+            nonlocal turn_sums
+            embeddings = self.infer(torch.stack(batch))
+            if turn_sums is None:
+                turn_sums = torch.zeros(len(turns), embeddings.shape[1])
+            index = torch.tensor(owners)
+            turn_sums.index_add_(0, index, embeddings)
+            turn_counts.index_add_(0, index, torch.ones(len(owners)))
+            batch.clear()
+            owners.clear()
+
+        for i, (_, start, end) in enumerate(turns):
+            turn_waveform = self.crop(audio, start, end)
+
+            if turn_waveform.shape[1] == 0:
+                continue
+
+            for crop in self.crops(turn_waveform):
+                batch.append(crop)
+                owners.append(i)
+
+                if len(batch) == self.batch_size:
+                    flush()
+
+        if batch:
+            flush()
+
+        if turn_sums is None:
+            return {}
+
+        speaker_embeddings = {}
+        for (speaker, _, _), emb_sum, count in zip(turns, turn_sums, turn_counts):
+            if count > 0:
+                speaker_embeddings.setdefault(speaker, []).append(emb_sum / count)
+
+        for speaker in speaker_embeddings:
+            speaker_embeddings[speaker] = torch.stack(speaker_embeddings[speaker]).mean(dim=0)
+
+        return speaker_embeddings
+
+    def cleanup(self):
+        del self.inference
+        del self.model
+        torch.cuda.empty_cache()
+
+
+def voices_to_dict(diarization, embedder: VoiceEmbedder, audio):
+    return embedder.embed(diarization, audio)
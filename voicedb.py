@@ -1,44 +1,286 @@
+import fcntl
+import json
+import logging
 import os
 import pickle
+import threading
+import time
+from contextlib import contextmanager
 
+import numpy as np
 import torch
-from torch.nn.functional import cosine_similarity
+from torch.nn.functional import normalize
 
+from voiceindex import VoiceMatch, create_index
 
+
+# Хранилище голосов на диске:
+#   voices.json      - размерность эмбеддинга и номер поколения (generation)
+#   voices.{gen}.f32 - уплотненная матрица нормализованных float32 эмбеддингов, открывается через mmap
+#   voices.{gen}.log - журнал добавленных после уплотнения эмбеддингов, только дописывается
+# Когда журнал разрастается, матрица и журнал сливаются в новое поколение,
+# а переключение на него - это атомарная замена voices.json
 class VoiceDb:
-    def __init__(self, path="voicedb/voices.pkl"):
+    def __init__(self, path="voicedb", index: str = "matrix", compact_every: int = 1024):
         self.path = path
+        self.index_kind = index
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.meta_path = os.path.join(self.path, "voices.json")
+        self.lock_path = os.path.join(self.path, "voices.lock")
+
+        with self.file_lock():
+            self.migrate(os.path.join(self.path, "voices.pkl"))
+            self.load()
+
+    def file(self, generation: int, ext: str) -> str:
+        return os.path.join(self.path, f"voices.{generation}.{ext}")
+
+    # shared - блокировка для чтения: читатели не мешают друг другу, но ждут запись и уплотнение
+    @contextmanager
+    def file_lock(self, shared: bool = False):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_meta(self) -> dict:
+        try:
+            with open(self.meta_path, "rt") as f:
+                return json.load(f)
+        except OSError:
+            return {"dim": None, "generation": 0}
+
+    def write_meta(self, meta: dict):
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.meta_path)
+
+    def meta_version(self):
+        try:
+            st = os.stat(self.meta_path)
+            return st.st_ino, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def migrate(self, pickle_path: str):
+        if os.path.exists(self.meta_path) or not os.path.exists(pickle_path):
+            return
+
+        with open(pickle_path, "rb") as f:
+            voices = pickle.load(f)
+
+        logging.info(f"Migrating {len(voices)} voices from {pickle_path}")
+
+        if voices:
+            matrix = normalize(torch.stack(voices).float(), dim=1).numpy()
+            self.write_generation(0, matrix)
+            self.write_meta({"dim": matrix.shape[1], "generation": 0})
+
+        os.replace(pickle_path, pickle_path + ".migrated")
+
+    def write_generation(self, generation: int, matrix: np.ndarray):
+        matrix_path = self.file(generation, "f32")
+        with open(matrix_path + ".tmp", "wb") as f:
+            f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(matrix_path + ".tmp", matrix_path)
+
+        open(self.file(generation, "log"), "wb").close()
+
+    def load(self):
+        self.version = self.meta_version()
+        meta = self.read_meta()
+        self.dim = meta["dim"]
+        self.generation = meta["generation"]
+
+        base = None
+        matrix_path = self.file(self.generation, "f32")
+        if self.dim is not None and os.path.getsize(matrix_path) > 0:
+            rows = os.path.getsize(matrix_path) // (4 * self.dim)
+            # mode="c" - приватное отображение: страницы общие для всех процессов, пока в них никто не пишет
+            base = torch.from_numpy(np.memmap(matrix_path, dtype=np.float32, mode="c", shape=(rows, self.dim)))
+
+        self.index = create_index(self.index_kind, base)
+        self.log_offset = 0
+        self.log_rows = 0
+        self.read_log()
+
+    def read_log(self):
+        if self.dim is None:
+            return
+
+        row_size = 4 * self.dim
+
         try:
-            with open(self.path, "rb") as f:
-                self.voices = pickle.load(f)
+            with open(self.file(self.generation, "log"), "rb") as f:
+                f.seek(self.log_offset)
+                data = f.read()
         except OSError:
-            os.mkdir("voicedb")
-            self.voices = []
-            self.dump()
+            return
 
-        self.update_matrix()
+        # недописанная при падении запись в конце журнала просто игнорируется
+        rows = len(data) // row_size
+        if rows == 0:
+            return
 
-    def dump(self):
-        with open(self.path, "wb") as f:
-            pickle.dump(self.voices, f)
-        self.update_matrix()
+        vectors = np.frombuffer(data[:rows * row_size], dtype=np.float32).reshape(rows, self.dim)
+        self.index.add(torch.from_numpy(vectors.copy()))
+        self.log_offset += rows * row_size
+        self.log_rows += rows
 
-    def update_matrix(self):
-        if self.voices:
-            self.voices_matrix = torch.stack(self.voices)
-        else:
-            self.voices_matrix = torch.empty((0, 0))
+    # Подхватывает записи, добавленные другими процессами. Уплотнение в другом процессе
+    # не может сменить поколение посреди чтения журнала, пока держится блокировка файла
+    def refresh(self):
+        with self.lock, self.file_lock(shared=True):
+            if self.meta_version() != self.version:
+                self.load()
+            else:
+                self.read_log()
 
     def add_scammer(self, voice: torch.Tensor):
-        self.voices.append(voice)
-        self.dump()
+        vector = normalize(voice.reshape(1, -1).float(), dim=1).numpy()
+
+        with self.lock, self.file_lock():
+            if self.meta_version() != self.version:
+                self.load()
+
+            if self.dim is None:
+                self.dim = vector.shape[1]
+                self.write_generation(self.generation, np.empty((0, self.dim), dtype=np.float32))
+                self.write_meta({"dim": self.dim, "generation": self.generation})
+                self.version = self.meta_version()
+
+            with open(self.file(self.generation, "log"), "ab") as f:
+                f.write(vector.astype(np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.read_log()
+
+            if self.log_rows >= self.compact_every:
+                self.compact()
+
+    def compact(self):
+        old_generation = self.generation
+        new_generation = old_generation + 1
+
+        matrix = np.fromfile(self.file(old_generation, "f32"), dtype=np.float32).reshape(-1, self.dim)
+        log = np.fromfile(self.file(old_generation, "log"), dtype=np.float32)
+        log = log[:len(log) // self.dim * self.dim].reshape(-1, self.dim)
+
+        self.write_generation(new_generation, np.concatenate([matrix, log]))
+        self.write_meta({"dim": self.dim, "generation": new_generation})
+        self.load()
+
+        for ext in ("f32", "log"):
+            try:
+                os.remove(self.file(old_generation, ext))
+            except OSError:
+                pass
+
+        logging.info(f"VoiceDb compacted into generation {new_generation}: {len(self.index)} voices")
+
+    # один проход по базе (одно матричное умножение) сразу для всех переданных голосов
+    def search_many(self, voices: torch.Tensor, k: int = 5, threshold: float = 0.8) -> list[list[VoiceMatch]]:
+        self.refresh()
+        scores, indices = self.index.search(voices, k)
+
+        return [
+            [
+                VoiceMatch(int(i), float(score))
+                for score, i in zip(row_scores, row_indices)
+                if i >= 0 and score >= threshold
+            ]
+            for row_scores, row_indices in zip(scores, indices)
+        ]
+
+    def search(self, voice: torch.Tensor, k: int = 5, threshold: float = 0.8) -> list[VoiceMatch]:
+        return self.search_many(voice.reshape(1, -1), k, threshold)[0]
 
     def find_voice(self, voice: torch.Tensor, threshold: float = 0.8) -> bool:
-        if self.voices_matrix.numel() == 0:
-            return False
+        return bool(self.search(voice, k=1, threshold=threshold))
+
+
+class LookupRequest:
+    def __init__(self, voices: torch.Tensor, k: int, threshold: float):
+        self.voices = voices
+        self.k = k
+        self.threshold = threshold
+        self.result: list[list[VoiceMatch]] | None = None
+        self.error: Exception | None = None
+        self.done = False
+
 
-        voice = voice.unsqueeze(0)
+# Собирает запросы к базе голосов из нескольких потоков (например, из нескольких одновременно
+# закончившихся звонков) и выполняет их одним search_many. Первый пришедший поток ждет max_wait,
+# собирает все, что успело накопиться, и раздает результаты остальным
+class BatchedVoiceDb:
+    def __init__(self, db: VoiceDb, max_wait: float = 0.01):
+        self.db = db
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.pending: list[LookupRequest] = []
 
-        sims = cosine_similarity(self.voices_matrix, voice, dim=1)
+    def add_scammer(self, voice: torch.Tensor):
+        self.db.add_scammer(voice)
+
+    def search_many(self, voices: torch.Tensor, k: int = 5, threshold: float = 0.8) -> list[list[VoiceMatch]]:
+        request = LookupRequest(voices.reshape(-1, voices.shape[-1]), k, threshold)
+
+        with self.cond:
+            self.pending.append(request)
+            leader = len(self.pending) == 1
+
+        if leader:
+            time.sleep(self.max_wait)
+            self.flush()
+
+        with self.cond:
+            while not request.done:
+                self.cond.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.result # type: ignore
 
-        return bool((sims >= threshold).any().item())
+    def flush(self):
+        with self.cond:
+            batch, self.pending = self.pending, []
+
+        try:
+            results = self.db.search_many(
+                torch.cat([r.voices for r in batch]),
+                k=max(r.k for r in batch),
+                threshold=min(r.threshold for r in batch),
+            )
+
+            offset = 0
+            for r in batch:
+                rows = results[offset:offset + len(r.voices)]
+                offset += len(r.voices)
+                r.result = [[m for m in row[:r.k] if m.score >= r.threshold] for row in rows]
+        except Exception as e:
+            for r in batch:
+                r.error = e
+
+        with self.cond:
+            for r in batch:
+                r.done = True
+            self.cond.notify_all()
+
+    def search(self, voice: torch.Tensor, k: int = 5, threshold: float = 0.8) -> list[VoiceMatch]:
+        return self.search_many(voice.reshape(1, -1), k, threshold)[0]
+
+    def find_voice(self, voice: torch.Tensor, threshold: float = 0.8) -> bool:
+        return bool(self.search(voice, k=1, threshold=threshold))
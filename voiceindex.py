@@ -0,0 +1,109 @@
+import threading
+
+import numpy as np
+import torch
+from torch.nn.functional import normalize
+
+
+class VoiceMatch:
+    def __init__(self, index: int, score: float):
+        self.index = index
+        self.score = score
+
+    def __repr__(self):
+        return f"VoiceMatch(index={self.index}, score={self.score:.3f})"
+
+
+# Векторы хранятся уже нормализованными в одной непрерывной матрице с запасом по размеру,
+# так что косинусная близость - это одно матричное умножение, а вставка не пересобирает матрицу.
+# base - уже нормализованная матрица только для чтения (например, отображенный в память файл),
+# новые векторы дописываются в отдельный буфер после нее
+class MatrixIndex:
+    def __init__(self, base: torch.Tensor | None = None, capacity: int = 1024):
+        self.base = base if base is not None else torch.empty((0, 0))
+        self.capacity = capacity
+        self.matrix: torch.Tensor | None = None
+        self.size = 0
+        self.view = torch.empty((0, 0))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.base) + self.size
+
+    def add(self, vectors: torch.Tensor):
+        vectors = normalize(vectors.reshape(-1, vectors.shape[-1]).float(), dim=1)
+
+        with self.lock:
+            if self.matrix is None:
+                self.matrix = torch.empty((max(self.capacity, len(vectors)), vectors.shape[1]))
+
+            needed = self.size + len(vectors)
+            if needed > self.matrix.shape[0]:
+                grown = torch.empty((max(needed, self.matrix.shape[0] * 2), self.matrix.shape[1]))
+                grown[:self.size] = self.matrix[:self.size]
+                self.matrix = grown
+
+            self.matrix[self.size:needed] = vectors
+            self.size = needed
+            self.view = self.matrix[:self.size]
+
+    def search(self, queries: torch.Tensor, k: int = 1) -> tuple[torch.Tensor, torch.Tensor]:
+        view = self.view
+        queries = normalize(queries.reshape(-1, queries.shape[-1]).float(), dim=1)
+
+        parts = [m for m in (self.base, view) if len(m) > 0]
+        if not parts:
+            return torch.empty((len(queries), 0)), torch.empty((len(queries), 0), dtype=torch.long)
+
+        sims = torch.cat([queries @ m.T for m in parts], dim=1)
+        return sims.topk(min(k, sims.shape[1]), dim=1)
+
+
+# Приближенный поиск через HNSW из faiss, для баз на сотни тысяч голосов
+class HnswIndex:
+    def __init__(self, m: int = 32, ef_search: int = 64):
+        import faiss
+
+        self.faiss = faiss
+        self.m = m
+        self.ef_search = ef_search
+        self.index = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return 0 if self.index is None else self.index.ntotal
+
+    def add(self, vectors: torch.Tensor):
+        vectors = normalize(vectors.reshape(-1, vectors.shape[-1]).float(), dim=1)
+
+        with self.lock:
+            if self.index is None:
+                self.index = self.faiss.IndexHNSWFlat(vectors.shape[1], self.m, self.faiss.METRIC_INNER_PRODUCT)
+                self.index.hnsw.efSearch = self.ef_search
+
+            self.index.add(np.ascontiguousarray(vectors.numpy(), dtype=np.float32))
+
+    def search(self, queries: torch.Tensor, k: int = 1) -> tuple[torch.Tensor, torch.Tensor]:
+        queries = normalize(queries.reshape(-1, queries.shape[-1]).float(), dim=1)
+
+        # HNSW из faiss не допускает поиск параллельно со вставкой, поэтому поиск идет под тем же замком
+        with self.lock:
+            if len(self) == 0:
+                return torch.empty((len(queries), 0)), torch.empty((len(queries), 0), dtype=torch.long)
+
+            k = min(k, len(self))
+            scores, indices = self.index.search(np.ascontiguousarray(queries.numpy(), dtype=np.float32), k) # type: ignore
+        return torch.from_numpy(scores), torch.from_numpy(indices)
+
+
+def create_index(kind: str, base: torch.Tensor | None = None):
+    match kind:
+        case "matrix":
+            return MatrixIndex(base)
+        case "hnsw":
+            index = HnswIndex()
+            if base is not None and len(base) > 0:
+                index.add(base)
+            return index
+
+    raise RuntimeError(f"Unknown voice index: {kind}")
@@ -0,0 +1,202 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import wait
+
+from taskqueue import TaskQueue
+
+
+# Сообщения от воркеров к API-процессу - короткие кортежи. Аудио передается путем к файлу
+# в очереди загрузок, результат - через общую базу результатов, поэтому по каналу идут только события.
+# У каждого воркера свой канал: воркер, упавший посреди записи, не может заблокировать чужие сообщения,
+# как это случилось бы с общей multiprocessing.Queue
+class Channel:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message: tuple):
+        with self.lock:
+            self.conn.send(message)
+
+
+class EventForwarder:
+    def __init__(self, channel: Channel):
+        self.channel = channel
+
+    # результат done API-процесс сам читает из базы результатов
+    def publish(self, task_id: str, event: str, data: dict | None = None):
+        self.channel.send(("event", task_id, event, None if event == "done" else data))
+
+
+class SpoolForwarder:
+    def __init__(self, channel: Channel):
+        self.channel = channel
+
+    def release(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not remove spooled file {path}: {e}")
+            return
+
+        self.channel.send(("release", size))
+
+
+# Поток API-процесса, который переносит сообщения воркеров в шину событий и учет очереди загрузок.
+# По управляющему каналу пул присылает читающий конец канала каждого запущенного воркера. Перезапущенный
+# воркер получает новый канал, а канал упавшего дочитывается до конца и закрывается: недописанное
+# сообщение дает ошибку чтения только в этом канале и не мешает остальным
+def forward_messages(control, events, spool, results):
+    readers = [control]
+
+    while readers:
+        for reader in wait(readers):
+            try:
+                message = reader.recv() # type: ignore
+            except (EOFError, OSError):
+                readers.remove(reader)
+                reader.close() # type: ignore
+                continue
+
+            match message:
+                case ("worker", conn):
+                    readers.append(conn)
+                case _:
+                    dispatch(message, events, spool, results)
+
+
+def dispatch(message: tuple, events, spool, results):
+    match message:
+        case ("event", task_id, "done", _):
+            record = results.get(task_id)
+            events.publish(task_id, "done", {"result": record[1] if record is not None else None})
+        case ("event", task_id, event, data):
+            events.publish(task_id, event, data)
+        case ("release", size):
+            spool.unreserve(size)
+
+
+# Отдельный процесс запускает воркеров по числу воркеров в каждой полосе. API-процесс моделей
+# не загружает и занимается только вводом-выводом. По умолчанию (start="spawn") каждый воркер загружает
+# модели своего этапа сам. С start="fork" пул загружает модели один раз и форкает от себя воркеров, которым
+# веса достаются через copy-on-write; CUDA форк после инициализации не переживает, поэтому так можно только на CPU.
+# Упавший воркер перезапускается с растущей паузой, а взятые им задачи возвращаются в очередь; задачи, исчерпавшие
+# попытки, передаются в give_up. Воркер, упавший max_restarts раз подряд, не проработав stable_time, останавливает пул.
+# Пул сам общается с API-процессом по управляющему каналу control
+class WorkerPool:
+    def __init__(self, env_factory, scheduler_factory, init_worker, control, start: str = "spawn", give_up=None, max_restarts: int = 5, stable_time: float = 60.0):
+        self.env_factory = env_factory
+        self.scheduler_factory = scheduler_factory
+        self.init_worker = init_worker
+        self.control = control
+        self.start_method = start
+        self.give_up = give_up
+        self.max_restarts = max_restarts
+        self.stable_time = stable_time
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.get_context("fork").Process(target=self.run, args=(os.getpid(),), name="worker-pool")
+        self.process.start()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=30)
+
+    def run(self, api_pid: int):
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        channel = Channel(self.control)
+        self.init_worker(channel)
+
+        env = self.env_factory() if self.start_method == "fork" else None
+        # torch импортирован, только если модели уже загружены; проверяем без импорта
+        torch = sys.modules.get("torch")
+        if self.start_method == "fork" and torch is not None and torch.cuda.is_initialized():
+            raise RuntimeError("CUDA is initialized in the worker pool, fork would break it in the workers; use WORKER_START=spawn")
+
+        context = multiprocessing.get_context(self.start_method)
+        scheduler = self.scheduler_factory(lambda: env)
+        tasks = TaskQueue.from_env()
+
+        slots = [(key, i) for key, lane in scheduler.lanes.items() for i in range(lane.workers)]
+        children = {}
+        # слот -> (сколько раз подряд воркер падал быстрее stable_time, время следующего запуска)
+        crashes: dict = {}
+        restarts: dict = {}
+
+        # У каждого запуска воркера свой канал. Читающий конец уходит в API-процесс, а копии пула
+        # закрываются, чтобы после смерти воркера у его канала не осталось пишущих концов
+        def spawn(slot):
+            key, i = slot
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            child = context.Process(target=work, args=(self.env_factory, self.scheduler_factory, self.init_worker, writer, key, env), name=f"{scheduler.lanes[key].name}-{i}", daemon=True)
+            child.start()
+            channel.send(("worker", reader))
+            reader.close()
+            writer.close()
+            children[child.sentinel] = (child, slot, time.monotonic())
+
+        try:
+            for slot in slots:
+                spawn(slot)
+
+            while True:
+                for sentinel in wait(list(children), timeout=1.0):
+                    child, slot, started = children.pop(sentinel) # type: ignore
+                    child.join()
+                    self.recover(tasks, child.pid)
+
+                    count = crashes.get(slot, 0) + 1 if time.monotonic() - started < self.stable_time else 1
+                    crashes[slot] = count
+                    if count > self.max_restarts:
+                        logging.critical(f"Worker {child.name} exited with code {child.exitcode} {count} times in a row, stopping the worker pool")
+                        return
+
+                    delay = min(2 ** (count - 1), self.stable_time)
+                    logging.error(f"Worker {child.name} exited with code {child.exitcode}, restarting in {delay:.0f} s")
+                    restarts[slot] = time.monotonic() + delay
+
+                for slot, at in list(restarts.items()):
+                    if time.monotonic() >= at:
+                        del restarts[slot]
+                        spawn(slot)
+
+                if os.getppid() != api_pid:
+                    logging.info("API process is gone, stopping workers")
+                    return
+        finally:
+            for child, *_ in children.values():
+                child.terminate()
+
+    def recover(self, tasks: TaskQueue, pid: int):
+        _, failed = tasks.recover(owner=pid)
+
+        for task in failed:
+            if self.give_up is None:
+                continue
+            try:
+                self.give_up(task)
+            except Exception:
+                logging.exception(f"Could not finish abandoned task {task.id}")
+
+
+# Точка входа процесса воркера (и самого пула). init_worker заново открывает базы (соединения SQLite нельзя
+# переносить через fork) и перенаправляет события и освобождение загрузок в API-процесс
+def work(env_factory, scheduler_factory, init_worker, writer, key, env):
+    init_worker(Channel(writer))
+
+    if env is None:
+        env = env_factory()
+
+    scheduler = scheduler_factory(lambda: env)
+    threading.current_thread().name = multiprocessing.current_process().name
+
+    scheduler.work(scheduler.lanes[key])